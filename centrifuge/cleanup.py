@@ -0,0 +1,81 @@
+# coding: utf-8
+# Copyright (c) Alexandr Emelin. MIT license.
+
+from collections import deque
+
+from tornado.ioloop import PeriodicCallback, IOLoop
+from tornado.gen import coroutine, Return
+
+from centrifuge.log import logger
+
+
+class CleanupQueue(object):
+    """
+    Node-wide queue of work left after closed connections - presence
+    removal and leave messages. Work of many connections merged and sent
+    into engine in rate-limited batches so mass disconnect does not flood
+    engine with commands.
+    """
+
+    # in milliseconds, how often queue processed
+    DEFAULT_INTERVAL = 100
+
+    # how many items processed at most every interval
+    DEFAULT_BATCH_SIZE = 1000
+
+    def __init__(self, application, io_loop=None):
+        self.application = application
+        self.io_loop = io_loop or IOLoop.instance()
+        config = self.application.settings.get("config", {})
+        self.interval = config.get("cleanup_interval", self.DEFAULT_INTERVAL)
+        self.batch_size = config.get("cleanup_batch_size", self.DEFAULT_BATCH_SIZE)
+        # (project_key, channel, uid) tuples
+        self.presences = deque()
+        # (subscription_key, message) tuples
+        self.leaves = deque()
+        self.processing = False
+        self.periodic = PeriodicCallback(self.process, self.interval, io_loop=self.io_loop)
+
+    def start(self):
+        self.periodic.start()
+
+    def stop(self):
+        self.periodic.stop()
+
+    def __len__(self):
+        return len(self.presences) + len(self.leaves)
+
+    def add(self, presences, leaves):
+        self.presences.extend(presences)
+        self.leaves.extend(leaves)
+
+    @staticmethod
+    def pop(queue, size):
+        return [queue.popleft() for _ in range(min(size, len(queue)))]
+
+    @coroutine
+    def process(self):
+        """
+        Send next batch of cleanup work into engine.
+        """
+        if self.processing or not len(self):
+            raise Return((True, None))
+
+        self.processing = True
+        engine = self.application.engine
+        try:
+            presences = self.pop(self.presences, self.batch_size)
+            leaves = self.pop(self.leaves, self.batch_size - len(presences))
+            if presences:
+                _, error = yield engine.remove_presence_many(presences)
+                if error:
+                    logger.error("presence cleanup failed: {0}".format(error))
+            if leaves:
+                yield [
+                    engine.publish_message(subscription_key, message, method="leave")
+                    for subscription_key, message in leaves
+                ]
+        finally:
+            self.processing = False
+
+        raise Return((True, None))
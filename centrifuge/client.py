@@ -4,6 +4,7 @@
 import six
 import uuid
 import time
+from collections import deque
 
 try:
     from urllib import urlencode
@@ -12,7 +13,7 @@ except ImportError:
     # noinspection PyUnresolvedReferences
     from urllib.parse import urlencode
 
-from tornado.ioloop import PeriodicCallback, IOLoop
+from tornado.ioloop import IOLoop
 from tornado.gen import coroutine, Return, sleep
 
 from jsonschema import validate, ValidationError
@@ -30,6 +31,14 @@ class Client(object):
     """
     application = None
 
+    # in bytes, amount of data transport can hold before client stops
+    # handing new messages to it and keeps them in its own queue
+    TRANSPORT_BUFFER_LIMIT = 65536
+
+    # in seconds, how often client retries to hand queued messages to
+    # overloaded transport
+    QUEUE_FLUSH_RETRY_DELAY = 0.1
+
     def __init__(self, sock, info):
         self.sock = sock
         self.info = info
@@ -41,8 +50,11 @@ class Client(object):
         self.default_info = {}
         self.project_name = None
         self.channels = None
-        self.presence_ping_task = None
         self.expire_timeout = None
+        self.queue = deque()
+        self.queue_size = 0
+        self.queue_flush_timeout = None
+        self.flush_scheduled = False
         logger.info("client created via {0} (uid: {1}, ip: {2})".format(
             self.sock.session.transport_name, self.uid, getattr(self.info, 'ip', '-')
         ))
@@ -59,8 +71,8 @@ class Client(object):
         Must be called when client connection closes. Here we are
         making different clean ups.
         """
-        if self.presence_ping_task:
-            self.presence_ping_task.stop()
+        if self.application.presence_scheduler:
+            self.application.presence_scheduler.remove(self)
 
         project_name = self.project_name
 
@@ -71,20 +83,34 @@ class Client(object):
 
         if project_name and self.channels is not None:
             channels = self.channels.copy()
-            for channel_name, channel_info in six.iteritems(channels):
-                yield self.application.engine.remove_presence(
-                    project_name, channel_name, self.uid
-                )
-                self.application.engine.remove_subscription(
-                    project_name, channel_name, self
-                )
-                project = self.application.get_project(project_name)
-                if project:
+            yield self.application.engine.remove_subscription_many([
+                (project_name, channel_name, self) for channel_name in channels
+            ])
+            presences = [
+                (project_name, channel_name, self.uid)
+                for channel_name, presence in six.iteritems(channels) if presence
+            ]
+            leaves = []
+            project = self.application.get_project(project_name)
+            if project:
+                for channel_name in channels:
                     namespace = self.application.get_namespace(
                         project, channel_name
                     )
                     if namespace and namespace["join_leave"]:
-                        self.send_leave_message(channel_name)
+                        leaves.append(self.get_join_leave_message(channel_name))
+
+            cleanup_queue = self.application.cleanup_queue
+            if cleanup_queue:
+                # presence and leave messages will be sent in batches
+                cleanup_queue.add(presences, leaves)
+            else:
+                if presences:
+                    yield self.application.engine.remove_presence_many(presences)
+                for subscription_key, message in leaves:
+                    self.application.engine.publish_message(
+                        subscription_key, message, method='leave'
+                    )
 
         self.channels = None
         self.channel_info = None
@@ -96,6 +122,7 @@ class Client(object):
         self.timestamp = None
         self.expire_timeout = None
         self.uid = None
+        self.clear_queue()
         raise Return((True, None))
 
     @coroutine
@@ -116,22 +143,147 @@ class Client(object):
             logger.error(err)
         raise Return((True, None))
 
-    @coroutine
-    def send(self, response):
+    def write(self, response):
         """
-        Send message directly to client.
+        Put encoded response into client's outbound queue and hand queued
+        messages to transport without waiting. Return False if connection
+        already closed or broken.
         """
         if not self.sock:
-            raise Return((False, None))
-
+            return False
+
+        self.queue.append(response)
+        self.queue_size += len(response)
+
+        if not self.check_queue_limits():
+            return False
+
+        if self.application.CLIENT_BATCH_MESSAGES:
+            # all messages queued during current IOLoop iteration
+            # will be sent to client as one frame
+            if not self.flush_scheduled:
+                self.flush_scheduled = True
+                IOLoop.current().add_callback(self.flush_batch)
+            return True
+
+        return self.flush()
+
+    def check_queue_limits(self):
+        """
+        Drop oldest messages or disconnect client if its outbound queue
+        exceeded configured limits. Return False if client disconnected.
+        """
+        application = self.application
+        max_size = application.CLIENT_QUEUE_MAX_SIZE
+        max_messages = application.CLIENT_QUEUE_MAX_MESSAGES
+
+        if self.queue_size <= max_size and len(self.queue) <= max_messages:
+            return True
+
+        if application.CLIENT_QUEUE_OVERFLOW == 'drop':
+            dropped = 0
+            while self.queue and (self.queue_size > max_size or len(self.queue) > max_messages):
+                self.queue_size -= len(self.queue.popleft())
+                dropped += 1
+            if application.collector:
+                application.collector.incr('queue_dropped', dropped)
+            return True
+
+        logger.info("client outbound queue overflowed (uid: {0})".format(self.uid))
+        if application.collector:
+            application.collector.incr('slow_disconnects')
+        self.clear_queue()
+        response = Response(method="disconnect", body={"reason": "slow"})
         try:
-            self.sock.send(response)
+            self.sock.send(response.as_message())
         except Exception as err:
-            logger.exception(err)
-            yield self.close_sock(pause=False)
-            raise Return((False, None))
+            logger.error(err)
+        self.close_sock(pause=False)
+        return False
 
-        raise Return((True, None))
+    def get_transport_buffer_size(self):
+        """
+        Return amount of data accepted by transport but not sent to client yet.
+        """
+        session = self.sock.session
+        size = len(getattr(session, 'send_queue', None) or '')
+        stream = getattr(getattr(session, 'handler', None), 'stream', None)
+        if stream is not None:
+            size += getattr(stream, '_write_buffer_size', 0)
+        return size
+
+    def flush(self):
+        """
+        Hand queued messages to transport until it becomes overloaded, in
+        this case retry a bit later.
+        """
+        while self.queue:
+            if self.get_transport_buffer_size() > self.TRANSPORT_BUFFER_LIMIT:
+                if not self.queue_flush_timeout:
+                    self.queue_flush_timeout = IOLoop.current().add_timeout(
+                        time.time() + self.QUEUE_FLUSH_RETRY_DELAY, self.retry_flush
+                    )
+                return True
+
+            if self.application.CLIENT_BATCH_MESSAGES:
+                message = self.pop_batch()
+            else:
+                message = self.queue.popleft()
+                self.queue_size -= len(message)
+            try:
+                self.sock.send(message)
+            except Exception as err:
+                logger.exception(err)
+                self.clear_queue()
+                self.close_sock(pause=False)
+                return False
+
+        return True
+
+    def pop_batch(self):
+        """
+        Take all queued messages as single JSON array. Messages which are
+        arrays themselves (multiple responses) are spliced into it.
+        """
+        if len(self.queue) == 1:
+            self.queue_size = 0
+            return self.queue.popleft()
+
+        parts = []
+        for message in self.queue:
+            if message.startswith('['):
+                message = message[1:-1]
+                if not message:
+                    continue
+            parts.append(message)
+
+        self.queue.clear()
+        self.queue_size = 0
+        return '[' + ','.join(parts) + ']'
+
+    def flush_batch(self):
+        self.flush_scheduled = False
+        if self.sock:
+            self.flush()
+
+    def retry_flush(self):
+        self.queue_flush_timeout = None
+        if self.sock:
+            self.flush()
+
+    def clear_queue(self):
+        if self.queue_flush_timeout:
+            IOLoop.current().remove_timeout(self.queue_flush_timeout)
+            self.queue_flush_timeout = None
+        self.queue.clear()
+        self.queue_size = 0
+
+    @coroutine
+    def send(self, response):
+        """
+        Send message directly to client.
+        """
+        raise Return((self.write(response), None))
 
     @coroutine
     def process_obj(self, obj):
@@ -196,7 +348,7 @@ class Client(object):
             if err:
                 # error occurred, connection must be closed
                 logger.error(err)
-                yield self.sock.send(multi_response.as_message())
+                self.write(multi_response.as_message())
                 yield self.close_sock()
                 raise Return((True, None))
 
@@ -213,7 +365,7 @@ class Client(object):
                 if err:
                     # close connection in case of any error
                     logger.error(err)
-                    yield self.sock.send(multi_response.as_message())
+                    self.write(multi_response.as_message())
                     yield self.send_disconnect_message()
                     yield self.close_sock()
                     raise Return((True, None))
@@ -227,20 +379,17 @@ class Client(object):
 
         raise Return((True, None))
 
-    @coroutine
-    def send_presence_ping(self):
+    def get_presences(self):
         """
-        Update presence information for all channels this client
-        subscribed to.
+        Return presence information for all channels with presence enabled
+        this client subscribed to.
         """
-        for channel, channel_info in six.iteritems(self.channels):
-            info = self.get_info(channel)
-            if channel not in self.channels:
-                continue
-            yield self.application.engine.add_presence(
-                self.project_name, channel, self.uid, info
-            )
-        raise Return((True, None))
+        if not self.channels:
+            return []
+        return [
+            (self.project_name, channel, self.uid, self.get_info(channel))
+            for channel, presence in six.iteritems(self.channels) if presence
+        ]
 
     def get_info(self, channel):
         """
@@ -372,10 +521,8 @@ class Client(object):
         }
 
         self.channels = {}
-        self.presence_ping_task = PeriodicCallback(
-            self.send_presence_ping, self.application.engine.presence_ping_interval
-        )
-        self.presence_ping_task.start()
+        if self.application.presence_scheduler:
+            self.application.presence_scheduler.add(self)
         self.application.add_connection(project_name, self.user, self.uid, self)
 
         conn_lifetime = project["connection_lifetime"]
@@ -517,17 +664,36 @@ class Client(object):
             project_name, channel, self
         )
 
-        self.channels[channel] = True
+        # remember if presence must be maintained for channel
+        presence = bool(namespace['presence'])
+        self.channels[channel] = presence
 
-        info = self.get_info(channel)
-
-        yield self.application.engine.add_presence(
-            project_name, channel, self.uid, info
-        )
+        if presence:
+            info = self.get_info(channel)
+            yield self.application.engine.add_presence(
+                project_name, channel, self.uid, info
+            )
 
         if namespace['join_leave']:
             self.send_join_message(channel)
 
+        if params.get('since'):
+            # return messages client missed while it was not subscribed
+            if namespace['history_size'] > 0 and namespace['history_lifetime'] > 0:
+                (messages, recovered), error = yield self.application.process_history_since(
+                    project,
+                    params
+                )
+            else:
+                (messages, recovered), error = ([], False), None
+            if error:
+                # subscription established but missed messages unknown -
+                # client must request history itself
+                logger.error("history since failed: {0}".format(error))
+            else:
+                body["messages"] = messages
+                body["recovered"] = recovered
+
         raise Return((body, None))
 
     @coroutine
@@ -558,14 +724,12 @@ class Client(object):
             project_name, channel, self
         )
 
-        try:
-            del self.channels[channel]
-        except KeyError:
-            pass
+        presence = self.channels.pop(channel, False)
 
-        yield self.application.engine.remove_presence(
-            project_name, channel, self.uid
-        )
+        if presence:
+            yield self.application.engine.remove_presence(
+                project_name, channel, self.uid
+            )
 
         if namespace['join_leave']:
             self.send_leave_message(channel)
@@ -671,16 +835,23 @@ class Client(object):
         if namespace['history_size'] <= 0 or namespace['history_lifetime'] <= 0:
             raise Return((body, self.application.NOT_AVAILABLE))
 
-        data, error = yield self.application.process_history(
-            project,
-            params
-        )
+        if params.get('since'):
+            (data, recovered), error = yield self.application.process_history_since(
+                project,
+                params
+            )
+            body["recovered"] = recovered
+        else:
+            data, error = yield self.application.process_history(
+                project,
+                params
+            )
         body["data"] = data
         raise Return((body, error))
 
-    def send_join_leave_message(self, channel, message_method):
+    def get_join_leave_message(self, channel):
         """
-        Generate and send message about join or leave event.
+        Return subscription key and message about join or leave event.
         """
         subscription_key = self.application.engine.get_subscription_key(
             self.project_name, channel
@@ -690,6 +861,13 @@ class Client(object):
             "channel": channel,
             "data": info
         }
+        return subscription_key, message
+
+    def send_join_leave_message(self, channel, message_method):
+        """
+        Generate and send message about join or leave event.
+        """
+        subscription_key, message = self.get_join_leave_message(channel)
         self.application.engine.publish_message(
             subscription_key, message, method=message_method
         )
@@ -22,8 +22,11 @@ from jsonschema import validate, ValidationError
 
 from centrifuge import utils
 from centrifuge.log import logger
-from centrifuge.metrics import Collector, Exporter
-from centrifuge.response import Response, MultiResponse
+from centrifuge.metrics import Collector, Exporter, EXPORTERS
+from centrifuge.monitor import LoopMonitor
+from centrifuge.presence import PresenceScheduler
+from centrifuge.cleanup import CleanupQueue
+from centrifuge.response import Response, MultiResponse, Envelope
 from centrifuge.schema import req_schema, server_api_schema
 from centrifuge.structure import validate_and_prepare_project_structure, structure_to_dict
 
@@ -65,6 +68,20 @@ class Application(tornado.web.Application):
     # maximum number of messages in single client API request
     CLIENT_API_MESSAGE_LIMIT = 100
 
+    # in bytes, maximum size of messages waiting in client's outbound queue
+    CLIENT_QUEUE_MAX_SIZE = 10485760
+
+    # maximum amount of messages waiting in client's outbound queue
+    CLIENT_QUEUE_MAX_MESSAGES = 10000
+
+    # what to do when client's outbound queue overflowed - "drop" oldest
+    # messages or "disconnect" slow client
+    CLIENT_QUEUE_OVERFLOW = 'disconnect'
+
+    # send all messages queued for client during one IOLoop iteration
+    # as single JSON array instead of separate frames
+    CLIENT_BATCH_MESSAGES = False
+
     # time in seconds to pause before closing expired connection
     # to get client a chance to refresh connection
     EXPIRED_CONNECTION_CLOSE_DELAY = 10
@@ -117,6 +134,12 @@ class Application(tornado.web.Application):
         # application engine
         self.engine = None
 
+        # refreshes presence information of node connections
+        self.presence_scheduler = None
+
+        # processes work left after closed connections in batches
+        self.cleanup_queue = None
+
         # list of coroutines that must be done before message publishing
         self.pre_publish_callbacks = []
 
@@ -146,6 +169,12 @@ class Application(tornado.web.Application):
         # export collected metrics into Graphite
         self.graphite_metrics = False
 
+        # expose collected metrics for Prometheus via HTTP
+        self.prometheus_metrics = False
+
+        # measures IOLoop lag
+        self.loop_monitor = None
+
         # initialize tornado's application
         super(Application, self).__init__(*args, **kwargs)
 
@@ -159,6 +188,8 @@ class Application(tornado.web.Application):
         self.init_callbacks()
         self.init_structure()
         self.init_engine()
+        self.init_presence()
+        self.init_cleanup()
         self.init_ping()
         self.init_metrics()
 
@@ -201,6 +232,22 @@ class Application(tornado.web.Application):
         if client_api_message_limit:
             self.CLIENT_API_MESSAGE_LIMIT = client_api_message_limit
 
+        client_queue_max_size = config.get('client_queue_max_size')
+        if client_queue_max_size:
+            self.CLIENT_QUEUE_MAX_SIZE = client_queue_max_size
+
+        client_queue_max_messages = config.get('client_queue_max_messages')
+        if client_queue_max_messages:
+            self.CLIENT_QUEUE_MAX_MESSAGES = client_queue_max_messages
+
+        client_queue_overflow = config.get('client_queue_overflow')
+        if client_queue_overflow:
+            self.CLIENT_QUEUE_OVERFLOW = client_queue_overflow
+
+        client_batch_messages = config.get('client_batch_messages')
+        if client_batch_messages:
+            self.CLIENT_BATCH_MESSAGES = client_batch_messages
+
         expired_connection_close_delay = config.get('expired_connection_close_delay')
         if expired_connection_close_delay:
             self.EXPIRED_CONNECTION_CLOSE_DELAY = expired_connection_close_delay
@@ -230,6 +277,20 @@ class Application(tornado.web.Application):
         """
         tornado.ioloop.IOLoop.instance().add_callback(self.engine.initialize)
 
+    def init_presence(self):
+        """
+        Start periodic refreshing of connections presence information.
+        """
+        self.presence_scheduler = PresenceScheduler(self)
+        self.presence_scheduler.start()
+
+    def init_cleanup(self):
+        """
+        Start processing of closed connections cleanup queue.
+        """
+        self.cleanup_queue = CleanupQueue(self)
+        self.cleanup_queue.start()
+
     def init_callbacks(self):
         """
         Fill custom callbacks with callable objects provided in config.
@@ -257,8 +318,9 @@ class Application(tornado.web.Application):
 
         self.log_metrics = metrics_config.get('log', False)
         self.graphite_metrics = metrics_config.get('graphite', False)
+        self.prometheus_metrics = metrics_config.get('prometheus', False)
 
-        if not self.log_metrics and not self.graphite_metrics:
+        if not self.log_metrics and not self.graphite_metrics and not self.prometheus_metrics:
             return
 
         self.collector = Collector()
@@ -271,10 +333,17 @@ class Application(tornado.web.Application):
 
             prefix += self.name
 
-            self.exporter = Exporter(
+            protocol = metrics_config.get("graphite_protocol", "udp")
+            if protocol not in EXPORTERS:
+                raise Exception("unknown graphite_protocol {0}, must be one of: {1}".format(
+                    protocol, ", ".join(sorted(EXPORTERS))
+                ))
+            self.exporter = EXPORTERS[protocol](
                 metrics_config["graphite_host"],
                 metrics_config["graphite_port"],
-                prefix=prefix
+                prefix=prefix,
+                max_udp_size=metrics_config.get("graphite_max_udp_size"),
+                max_buffer_size=metrics_config.get("graphite_max_buffer_size")
             )
 
         self.periodic_metrics_export = tornado.ioloop.PeriodicCallback(
@@ -283,6 +352,13 @@ class Application(tornado.web.Application):
         )
         self.periodic_metrics_export.start()
 
+        self.loop_monitor = LoopMonitor(
+            self.collector,
+            interval=metrics_config.get("ioloop_lag_interval"),
+            blocking_threshold=metrics_config.get("ioloop_blocking_threshold")
+        )
+        self.loop_monitor.start()
+
     def flush_metrics(self):
 
         if not self.collector:
@@ -374,6 +450,7 @@ class Application(tornado.web.Application):
             'channels': self.get_channels_count(),
             'clients': self.get_clients_count(),
             'unique_clients': self.get_unique_clients_count(),
+            'cleanup_queue': len(self.cleanup_queue) if self.cleanup_queue else 0,
         }
         return gauges
 
@@ -626,28 +703,27 @@ class Application(tornado.web.Application):
         if not namespace:
             raise Return((False, self.NAMESPACE_NOT_FOUND))
 
+        # encode message once and reuse it for all destinations
+        envelope = Envelope(message)
+
         if namespace['watch']:
             # send to admin channel
-            self.engine.publish_admin_message({
-                "method": "message",
-                "body": {
-                    "project": project_name,
-                    "message": message
-                }
-            })
+            self.engine.publish_admin_message(
+                envelope.as_admin_message(project_name)
+            )
 
         # send to event channel
         subscription_key = self.engine.get_subscription_key(
             project_name, channel
         )
 
-        self.engine.publish_message(subscription_key, message)
+        self.engine.publish_message(subscription_key, envelope)
 
         history_size = namespace['history_size']
         history_lifetime = namespace['history_lifetime']
         if history_size > 0 and history_lifetime > 0:
             yield self.engine.add_history_message(
-                project_name, channel, message,
+                project_name, channel, envelope,
                 history_size=history_size,
                 history_lifetime=history_lifetime
             )
@@ -721,15 +797,40 @@ class Application(tornado.web.Application):
     @coroutine
     def process_history(self, project, params):
         """
-        Return a list of last messages sent into channel.
+        Return a list of last messages sent into channel. Newest messages
+        come first, limit and offset allow to get only part of history.
+        With since return only messages newer than message with that uid
+        together with recovered flag.
         """
+        if params.get("since"):
+            (data, recovered), error = yield self.process_history_since(project, params)
+            raise Return(({"data": data, "recovered": recovered}, error))
+
         project_name = project['name']
         channel = params.get("channel")
-        data, error = yield self.engine.get_history(project_name, channel)
+        data, error = yield self.engine.get_history(
+            project_name, channel, limit=params.get("limit"), offset=params.get("offset", 0),
+            raw=True
+        )
         if error:
             raise Return(([], self.INTERNAL_SERVER_ERROR))
         raise Return((data, None))
 
+    @coroutine
+    def process_history_since(self, project, params):
+        """
+        Return messages sent into channel after message with uid from since
+        parameter and flag showing if all of them are still in history.
+        """
+        project_name = project['name']
+        channel = params.get("channel")
+        data, error = yield self.engine.get_history_since(
+            project_name, channel, params.get("since")
+        )
+        if error:
+            raise Return((([], False), self.INTERNAL_SERVER_ERROR))
+        raise Return((data, None))
+
     @coroutine
     def process_presence(self, project, params):
         """
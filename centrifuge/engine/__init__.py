@@ -1,8 +1,15 @@
 # coding: utf-8
 # Copyright (c) Alexandr Emelin. MIT license.
 
+import six
+import time
+from collections import deque
+
 from tornado.ioloop import IOLoop
-from tornado.gen import coroutine, Return
+from tornado.gen import coroutine, Return, moment
+
+from centrifuge.utils import json_encode
+from centrifuge.response import Response, Envelope
 
 
 class BaseEngine(object):
@@ -31,6 +38,14 @@ class BaseEngine(object):
     # receiving presence ping
     DEFAULT_PRESENCE_EXPIRE_INTERVAL = 60
 
+    # how many clients get message before broadcast checks if it
+    # must give control back to IOLoop
+    DEFAULT_BROADCAST_CHUNK_SIZE = 1000
+
+    # in milliseconds, how long broadcast can hold IOLoop before
+    # giving other callbacks a chance to run
+    DEFAULT_BROADCAST_TIME_SLICE = 20
+
     NAME = 'Base engine'
 
     def __init__(self, application, io_loop=None):
@@ -53,6 +68,22 @@ class BaseEngine(object):
             self.DEFAULT_PRESENCE_EXPIRE_INTERVAL
         )
 
+        self.broadcast_chunk_size = self.config.get(
+            "broadcast_chunk_size",
+            self.DEFAULT_BROADCAST_CHUNK_SIZE
+        )
+
+        self.broadcast_time_slice = self.config.get(
+            "broadcast_time_slice",
+            self.DEFAULT_BROADCAST_TIME_SLICE
+        )
+
+        # subscription keys mapped to dictionaries of subscribed clients
+        self.subscriptions = {}
+
+        # channels with broadcast in progress and messages waiting for it
+        self._broadcast_queues = {}
+
     def initialize(self):
         """
         Put engine specific initialization logic here. At this moment IO LOOP already started.
@@ -65,10 +96,87 @@ class BaseEngine(object):
         """
         return ".".join([self.prefix, project_key, channel])
 
+    @staticmethod
+    def encode_response(body, method):
+        """
+        Create response to send into channel. Body can be Envelope with
+        already encoded message.
+        """
+        if isinstance(body, Envelope):
+            return body.as_response(method)
+        return Response(method=method, body=body).as_message()
+
+    @staticmethod
+    def encode_message(message):
+        """
+        Encode message if it was not encoded before.
+        """
+        if isinstance(message, six.string_types):
+            return message
+        return json_encode(message)
+
+    @coroutine
+    def broadcast(self, channel, message):
+        """
+        Send already encoded message to all clients subscribed on channel.
+        If broadcast into this channel is in progress message will be sent
+        right after it to keep messages order.
+        """
+        if channel not in self.subscriptions:
+            raise Return((True, None))
+
+        if channel in self._broadcast_queues:
+            self._broadcast_queues[channel].append(message)
+            raise Return((True, None))
+
+        queue = self._broadcast_queues[channel] = deque([message])
+        try:
+            while queue:
+                yield self.fan_out(channel, queue.popleft())
+        finally:
+            del self._broadcast_queues[channel]
+
+        raise Return((True, None))
+
+    @coroutine
+    def fan_out(self, channel, message):
+        """
+        Hand message to every subscriber without waiting for each send.
+        Subscribers are processed in chunks, between chunks control goes back
+        to IOLoop if broadcast already took more than its time slice.
+        """
+        subscribers = self.subscriptions.get(channel)
+        if not subscribers:
+            raise Return((True, None))
+
+        timer = None
+        if self.application.collector:
+            timer = self.application.collector.get_timer('broadcast')
+
+        clients = list(six.iteritems(subscribers))
+        chunk_size = self.broadcast_chunk_size
+        time_slice = self.broadcast_time_slice / 1000.0
+        slice_started = time.time()
+
+        for i in six.moves.range(0, len(clients), chunk_size):
+            if time.time() - slice_started > time_slice:
+                yield moment
+                slice_started = time.time()
+            for uid, client in clients[i:i + chunk_size]:
+                # client could unsubscribe while we were not holding IOLoop
+                if uid in subscribers:
+                    client.write(message)
+
+        if timer:
+            timer.stop()
+
+        raise Return((True, None))
+
     @coroutine
     def publish_message(self, channel, body, method="message"):
         """
-        Send message with body into channel with specified method.
+        Send message with body into channel with specified method. Body
+        can be Envelope with already encoded message.
         """
         raise Return((True, None))
 
@@ -85,6 +193,7 @@ class BaseEngine(object):
         """
         Send message to admin channel.
         This channel for sending events to administrative interface.
+        Message can be already encoded into JSON string.
         """
         raise Return((True, None))
 
@@ -104,6 +213,15 @@ class BaseEngine(object):
         """
         raise Return((True, None))
 
+    @coroutine
+    def remove_subscription_many(self, subscriptions):
+        """
+        Remove subscriptions for list of (project_key, channel, client) tuples.
+        """
+        results = yield [self.remove_subscription(*x) for x in subscriptions]
+        errors = [error for _, error in results if error]
+        raise Return((not errors, errors[0] if errors else None))
+
     @coroutine
     def add_presence(self, project_key, channel, uid, user_info, presence_timeout=None):
         """
@@ -112,6 +230,16 @@ class BaseEngine(object):
         """
         raise Return((True, None))
 
+    @coroutine
+    def add_presence_many(self, presences):
+        """
+        Add (or update) presence information for list of (project_key, channel,
+        uid, user_info) tuples. Engines can send all of them at once.
+        """
+        results = yield [self.add_presence(*x) for x in presences]
+        errors = [error for _, error in results if error]
+        raise Return((not errors, errors[0] if errors else None))
+
     @coroutine
     def remove_presence(self, project_key, channel, uid):
         """
@@ -119,6 +247,16 @@ class BaseEngine(object):
         """
         raise Return((True, None))
 
+    @coroutine
+    def remove_presence_many(self, presences):
+        """
+        Remove presence information for list of (project_key, channel, uid)
+        tuples.
+        """
+        results = yield [self.remove_presence(*x) for x in presences]
+        errors = [error for _, error in results if error]
+        raise Return((not errors, errors[0] if errors else None))
+
     @coroutine
     def get_presence(self, project_key, channel):
         """
@@ -130,12 +268,33 @@ class BaseEngine(object):
     def add_history_message(self, project_key, channel, message, history_size, history_lifetime):
         """
         Add new history message for channel, trim history if needed.
+        Message can be Envelope with already encoded message.
         """
         raise Return((True, None))
 
     @coroutine
-    def get_history(self, project_key, channel):
+    def get_history(self, project_key, channel, limit=None, offset=0, raw=False):
         """
-        Return history messages for channel in project.
+        Return history messages for channel in project starting from newest.
+        At most limit messages returned (all if limit not set) skipping
+        first offset messages. With raw engine can return RawJSON array
+        of messages instead of list to put into response as is.
         """
         raise Return((None, None))
+
+    @coroutine
+    def get_history_since(self, project_key, channel, since):
+        """
+        Return history messages published into channel after message with
+        uid since (starting from newest) and flag showing if message with
+        uid since is still in history - i.e. no messages were lost. If it's
+        not then all history returned.
+        """
+        messages, error = yield self.get_history(project_key, channel)
+        if error:
+            raise Return((None, error))
+        messages = messages or []
+        for i, message in enumerate(messages):
+            if message.get("uid") == since:
+                raise Return(((messages[:i], True), None))
+        raise Return(((messages, False), None))
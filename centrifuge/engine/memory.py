@@ -3,15 +3,16 @@
 
 import time
 import six
-import heapq
+from collections import deque
+from itertools import islice
 
-from tornado.gen import coroutine, Return
+from tornado.gen import coroutine, Return, moment
 from tornado.ioloop import PeriodicCallback
 
-from centrifuge.utils import json_encode
-from centrifuge.response import Response
+from centrifuge.response import Envelope
 from centrifuge.log import logger
 from centrifuge.engine import BaseEngine
+from centrifuge.wheel import TimingWheel
 
 
 class Engine(BaseEngine):
@@ -26,20 +27,39 @@ class Engine(BaseEngine):
 
     HISTORY_EXPIRE_TASK_INTERVAL = 60000  # once in a minute
 
+    PRESENCE_EXPIRE_TASK_INTERVAL = 5000  # once in 5 seconds
+
+    # how many presence entries expired before checking time slice
+    PRESENCE_EXPIRE_CHUNK_SIZE = 1000
+
+    # in milliseconds, how long presence expiration runs before giving
+    # control back to IOLoop
+    PRESENCE_EXPIRE_TIME_SLICE = 20
+
     def __init__(self, *args, **kwargs):
         super(Engine, self).__init__(*args, **kwargs)
-        self.subscriptions = {}
         self.history = {}
-        self.history_expire_at = {}
-        self.history_expire_heap = []
+        # capacity of every history ring buffer (deque.maxlen is not
+        # available in Python 2.6)
+        self.history_sizes = {}
+        # history keys with their expiration time, one entry per key
+        self.history_expire = TimingWheel()
         self.presence = {}
+        # (presence key, uid) pairs with their expiration time
+        self.presence_expire = TimingWheel()
+        self.presence_expire_running = False
         self.history_expire_task = PeriodicCallback(
             self.check_history_expire,
             self.HISTORY_EXPIRE_TASK_INTERVAL
         )
+        self.presence_expire_task = PeriodicCallback(
+            self.check_presence_expire,
+            self.PRESENCE_EXPIRE_TASK_INTERVAL
+        )
 
     def initialize(self):
         self.history_expire_task.start()
+        self.presence_expire_task.start()
         logger.info("Memory engine initialized")
 
     @coroutine
@@ -59,7 +79,7 @@ class Engine(BaseEngine):
 
     @coroutine
     def handle_admin_message(self, message):
-        message = json_encode(message)
+        message = self.encode_message(message)
         for uid, connection in six.iteritems(self.application.admin_connections):
             if uid not in self.application.admin_connections:
                 continue
@@ -93,24 +113,10 @@ class Engine(BaseEngine):
 
     @coroutine
     def handle_message(self, channel, method, body):
-
-        if channel not in self.subscriptions:
-            raise Return((True, None))
-
-        timer = None
-        if self.application.collector:
-            timer = self.application.collector.get_timer('broadcast')
-
-        response = Response(method=method, body=body)
-        prepared_response = response.as_message()
-        for uid, client in six.iteritems(self.subscriptions[channel]):
-            if channel in self.subscriptions and uid in self.subscriptions[channel]:
-                yield client.send(prepared_response)
-
-        if timer:
-            timer.stop()
-
-        raise Return((True, None))
+        result, error = yield self.broadcast(
+            channel, self.encode_response(body, method)
+        )
+        raise Return((result, error))
 
     @coroutine
     def add_subscription(self, project_key, channel, client):
@@ -126,19 +132,26 @@ class Engine(BaseEngine):
 
     @coroutine
     def remove_subscription(self, project_key, channel, client):
+        result, error = yield self.remove_subscription_many([(project_key, channel, client)])
+        raise Return((result, error))
 
-        subscription_key = self.get_subscription_key(project_key, channel)
+    @coroutine
+    def remove_subscription_many(self, subscriptions):
 
-        try:
-            del self.subscriptions[subscription_key][client.uid]
-        except KeyError:
-            pass
+        for project_key, channel, client in subscriptions:
 
-        try:
-            if not self.subscriptions[subscription_key]:
-                del self.subscriptions[subscription_key]
-        except KeyError:
-            pass
+            subscription_key = self.get_subscription_key(project_key, channel)
+
+            try:
+                del self.subscriptions[subscription_key][client.uid]
+            except KeyError:
+                pass
+
+            try:
+                if not self.subscriptions[subscription_key]:
+                    del self.subscriptions[subscription_key]
+            except KeyError:
+                pass
 
         raise Return((True, None))
 
@@ -149,7 +162,17 @@ class Engine(BaseEngine):
     def add_presence(self, project_key, channel, uid, user_info, presence_timeout=None):
         now = int(time.time())
         expire_at = now + (presence_timeout or self.presence_timeout)
+        self.set_presence(project_key, channel, uid, user_info, expire_at)
+        raise Return((True, None))
+
+    @coroutine
+    def add_presence_many(self, presences):
+        expire_at = int(time.time()) + self.presence_timeout
+        for project_key, channel, uid, user_info in presences:
+            self.set_presence(project_key, channel, uid, user_info, expire_at)
+        raise Return((True, None))
 
+    def set_presence(self, project_key, channel, uid, user_info, expire_at):
         hash_key = self.get_presence_key(project_key, channel)
 
         if hash_key not in self.presence:
@@ -159,16 +182,26 @@ class Engine(BaseEngine):
             'expire_at': expire_at,
             'user_info': user_info
         }
+        self.presence_expire.add((hash_key, uid), expire_at)
 
-        raise Return((True, None))
+    def delete_presence(self, hash_key, uid):
+        self.presence_expire.discard((hash_key, uid))
+        presence = self.presence.get(hash_key)
+        if presence is None:
+            return
+        presence.pop(uid, None)
+        if not presence:
+            del self.presence[hash_key]
 
     @coroutine
     def remove_presence(self, project_key, channel, uid):
-        hash_key = self.get_presence_key(project_key, channel)
-        try:
-            del self.presence[hash_key][uid]
-        except KeyError:
-            pass
+        result, error = yield self.remove_presence_many([(project_key, channel, uid)])
+        raise Return((result, error))
+
+    @coroutine
+    def remove_presence_many(self, presences):
+        for project_key, channel, uid in presences:
+            self.delete_presence(self.get_presence_key(project_key, channel), uid)
 
         raise Return((True, None))
 
@@ -187,16 +220,7 @@ class Engine(BaseEngine):
                     keys_to_delete.append(uid)
 
             for uid in keys_to_delete:
-                try:
-                    del self.presence[hash_key][uid]
-                except KeyError:
-                    pass
-
-            if not self.presence[hash_key]:
-                try:
-                    del self.presence[hash_key]
-                except KeyError:
-                    pass
+                self.delete_presence(hash_key, uid)
 
         raise Return((to_return, None))
 
@@ -209,52 +233,91 @@ class Engine(BaseEngine):
         history_key = self.get_history_key(project_key, channel)
 
         expire_at = int(time.time()) + history_lifetime
-        self.history_expire_at[history_key] = expire_at
-        heapq.heappush(self.history_expire_heap, (expire_at, history_key))
+        self.history_expire.add(history_key, expire_at)
 
-        if history_key not in self.history:
-            self.history[history_key] = []
+        if isinstance(message, Envelope):
+            message = message.message
 
-        self.history[history_key].insert(0, message)
-        self.history[history_key] = self.history[history_key][:history_size]
+        history = self.history.get(history_key)
+        if history is None or self.history_sizes.get(history_key) != history_size:
+            # ring buffer with newest messages on the left
+            history = deque(islice(history or (), history_size), maxlen=history_size)
+            self.history[history_key] = history
+            self.history_sizes[history_key] = history_size
+
+        history.appendleft(message)
 
         raise Return((True, None))
 
-    @coroutine
-    def get_history(self, project_key, channel):
+    def get_history_buffer(self, project_key, channel):
+        """
+        Return history ring buffer of channel or empty tuple if channel
+        has no actual history.
+        """
         history_key = self.get_history_key(project_key, channel)
 
         now = int(time.time())
 
-        if history_key in self.history_expire_at:
-            expire_at = self.history_expire_at[history_key]
-            if expire_at <= now:
-                self.remove_history(history_key)
-                raise Return(([], None))
+        expire_at = self.history_expire.get(history_key)
+        if expire_at is not None and expire_at <= now:
+            self.remove_history(history_key)
+            return ()
 
-        try:
-            data = self.history[history_key]
-        except KeyError:
-            data = []
+        return self.history.get(history_key, ())
 
+    @coroutine
+    def get_history(self, project_key, channel, limit=None, offset=0, raw=False):
+        history = self.get_history_buffer(project_key, channel)
+        if limit or offset:
+            data = list(islice(history, offset, offset + limit if limit else None))
+        else:
+            data = list(history)
         raise Return((data, None))
 
+    @coroutine
+    def get_history_since(self, project_key, channel, since):
+        history = self.get_history_buffer(project_key, channel)
+        messages = []
+        for message in history:
+            if message.get("uid") == since:
+                raise Return(((messages, True), None))
+            messages.append(message)
+        raise Return(((messages, False), None))
+
     def remove_history(self, history_key):
         try:
             del self.history[history_key]
         except KeyError:
             pass
+        self.history_sizes.pop(history_key, None)
+        self.history_expire.discard(history_key)
+
+    @coroutine
+    def check_presence_expire(self):
+        """
+        Remove expired presence of clients which did not remove it
+        themselves. Gives control back to IOLoop when running too long.
+        """
+        if self.presence_expire_running:
+            raise Return((True, None))
+        self.presence_expire_running = True
         try:
-            del self.history_expire_at[history_key]
-        except KeyError:
-            pass
+            now = int(time.time())
+            time_slice = self.PRESENCE_EXPIRE_TIME_SLICE / 1000.0
+            slice_started = time.time()
+            while True:
+                expired = self.presence_expire.expire(now, limit=self.PRESENCE_EXPIRE_CHUNK_SIZE)
+                for hash_key, uid in expired:
+                    self.delete_presence(hash_key, uid)
+                if len(expired) < self.PRESENCE_EXPIRE_CHUNK_SIZE:
+                    break
+                if time.time() - slice_started > time_slice:
+                    yield moment
+                    slice_started = time.time()
+        finally:
+            self.presence_expire_running = False
+        raise Return((True, None))
 
     def check_history_expire(self):
-        now = int(time.time())
-        while self.history_expire_heap:
-            if self.history_expire_heap[0][0] <= now:
-                expire, history_key = heapq.heappop(self.history_expire_heap)
-                if history_key in self.history_expire_at and self.history_expire_at[history_key] <= now:
-                    self.remove_history(history_key)
-            else:
-                break
+        for history_key in self.history_expire.expire(int(time.time())):
+            self.remove_history(history_key)
@@ -3,6 +3,8 @@
 
 import time
 import six
+import hashlib
+from functools import partial
 
 try:
     import urlparse
@@ -10,15 +12,16 @@ except ImportError:
     import urllib.parse as urlparse
 
 from tornado.ioloop import PeriodicCallback
-from tornado.gen import coroutine, Return, Task
+from tornado.gen import coroutine, Return, Task, sleep
 from tornado.iostream import StreamClosedError
 
 import toredis
 
 from centrifuge.utils import json_encode, json_decode
-from centrifuge.response import Response
+from centrifuge.response import Envelope, RawJSON
 from centrifuge.log import logger
 from centrifuge.engine import BaseEngine
+from centrifuge.wheel import TimingWheel
 
 from tornado.options import define
 
@@ -46,6 +49,19 @@ define(
     "redis_api", default=False, help="enable Redis API listener", type=bool
 )
 
+define(
+    "redis_workers", default=4, help="amount of Redis connections for presence and history commands", type=int
+)
+
+define(
+    "redis_unsubscribe_linger", default=0,
+    help="seconds to stay subscribed on Redis channel after last client left it", type=int
+)
+
+define(
+    "redis_presence_gc", default=False, help="periodically remove expired presence from Redis", type=bool
+)
+
 
 range_func = six.moves.xrange
 
@@ -68,6 +84,130 @@ def dict_from_list(key_value_list):
     )
 
 
+# KEYS[1] - presence set key, KEYS[2] - presence hash key
+# ARGV[1] - expire at timestamp, ARGV[2] - client uid, ARGV[3] - encoded user info
+ADD_PRESENCE_SOURCE = """
+redis.call("zadd", KEYS[1], ARGV[1], ARGV[2])
+redis.call("hset", KEYS[2], ARGV[2], ARGV[3])
+return 1
+"""
+
+# KEYS[1] - presence set key, KEYS[2] - presence hash key
+# ARGV[1] - current timestamp
+EXPIRE_PRESENCE_SOURCE = """
+local expired = redis.call("zrangebyscore", KEYS[1], "0", ARGV[1])
+if #expired > 0 then
+  for _, uid in ipairs(expired) do
+    redis.call("hdel", KEYS[2], uid)
+  end
+  redis.call("zremrangebyscore", KEYS[1], "0", ARGV[1])
+end
+"""
+
+# KEYS[1] - presence set key, KEYS[2] - presence hash key
+# ARGV[1] - current timestamp
+GET_PRESENCE_SOURCE = EXPIRE_PRESENCE_SOURCE + """
+return redis.call("hgetall", KEYS[2])
+"""
+
+
+# KEYS[1] - history list key
+# ARGV[1] - uid of message to look for, ARGV[2] - amount of messages read at once
+# returns 1 if message found or 0 if not and then messages newer than it
+HISTORY_SINCE_SOURCE = """
+local chunk = tonumber(ARGV[2])
+local result = {0}
+local start = 0
+while true do
+  local messages = redis.call("lrange", KEYS[1], start, start + chunk - 1)
+  for _, message in ipairs(messages) do
+    if string.find(message, ARGV[1], 1, true) and cjson.decode(message)["uid"] == ARGV[1] then
+      result[1] = 1
+      return result
+    end
+    result[#result + 1] = message
+  end
+  if #messages < chunk then
+    return result
+  end
+  start = start + chunk
+end
+"""
+
+
+class Script(object):
+    """
+    Lua script executed on Redis server side. Script called by its SHA1
+    digest so we don't send its source on every call.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+class CommandBatch(object):
+    """
+    Collect Redis commands issued during one IOLoop iteration and send them
+    to Redis as one pipelined write. Every caller gets results of its own
+    commands only.
+    """
+
+    def __init__(self, engine, get_client):
+        self.engine = engine
+        self.get_client = get_client
+        self.commands = []
+        self.callbacks = []
+        self.scheduled = False
+
+    def add(self, commands, callback=None):
+        """
+        Add list of commands to batch. Callback will be called with
+        (results, error) tuple when Redis replies.
+        """
+        self.commands.extend(commands)
+        self.callbacks.append((callback, len(commands)))
+        if not self.scheduled:
+            self.scheduled = True
+            self.engine.io_loop.add_callback(self.flush)
+
+    def flush(self):
+        self.scheduled = False
+        commands, callbacks = self.commands, self.callbacks
+        self.commands, self.callbacks = [], []
+        if not commands:
+            return
+
+        client = self.get_client()
+        try:
+            if not client.is_connected():
+                raise StreamClosedError()
+            client.send_messages(commands, partial(self.on_results, callbacks))
+        except StreamClosedError as e:
+            self.engine._need_reconnect = True
+            logger.error("can not send commands to Redis, connection closed")
+            self.on_error(callbacks, e)
+
+    @classmethod
+    def on_results(cls, callbacks, results):
+        if results is None:
+            # connection closed before Redis replied
+            cls.on_error(callbacks, StreamClosedError())
+            return
+
+        offset = 0
+        for callback, count in callbacks:
+            if callback:
+                callback((results[offset:offset + count], None))
+            offset += count
+
+    @staticmethod
+    def on_error(callbacks, error):
+        for callback, _ in callbacks:
+            if callback:
+                callback((None, error))
+
+
 class Engine(BaseEngine):
     """
     This is Redis engine. It allows to start many instances of Centrifuge and they will
@@ -79,6 +219,35 @@ class Engine(BaseEngine):
 
     OK_RESPONSE = b'OK'
 
+    ADD_PRESENCE_SCRIPT = Script(ADD_PRESENCE_SOURCE)
+
+    GET_PRESENCE_SCRIPT = Script(GET_PRESENCE_SOURCE)
+
+    EXPIRE_PRESENCE_SCRIPT = Script(EXPIRE_PRESENCE_SOURCE)
+
+    HISTORY_SINCE_SCRIPT = Script(HISTORY_SINCE_SOURCE)
+
+    SCRIPTS = (ADD_PRESENCE_SCRIPT, GET_PRESENCE_SCRIPT, EXPIRE_PRESENCE_SCRIPT, HISTORY_SINCE_SCRIPT)
+
+    # how many history messages read at once when looking for message
+    HISTORY_SINCE_CHUNK_SIZE = 100
+
+    # maximum amount of channels in single SUBSCRIBE or UNSUBSCRIBE command
+    SUBSCRIBE_BATCH_SIZE = 5000
+
+    # in seconds, how long worker connection can leave health check
+    # PING without reply before it will be reconnected
+    WORKER_PING_TIMEOUT = 5
+
+    # in milliseconds, how often one of nodes removes expired presence
+    PRESENCE_GC_INTERVAL = 60000
+
+    # how many keys requested by one SCAN command during presence collection
+    PRESENCE_GC_SCAN_COUNT = 100
+
+    # in seconds, pause between SCAN commands during presence collection
+    PRESENCE_GC_SCAN_DELAY = 0.1
+
     def __init__(self, *args, **kwargs):
         super(Engine, self).__init__(*args, **kwargs)
 
@@ -102,14 +271,49 @@ class Engine(BaseEngine):
 
         self.subscriber = toredis.Client(io_loop=self.io_loop)
         self.publisher = toredis.Client(io_loop=self.io_loop)
-        self.worker = toredis.Client(io_loop=self.io_loop)
+        self.workers = [
+            toredis.Client(io_loop=self.io_loop) for _ in range_func(max(self.options.redis_workers, 1))
+        ]
         if self.options.redis_api:
             self.listener = toredis.Client(io_loop=self.io_loop)
 
-        self.subscriptions = {}
+        # worker connections mapped to time when health check PING was sent
+        self._worker_pings = {}
+
+        # subscription keys to send in next SUBSCRIBE and UNSUBSCRIBE commands
+        self._pending_subscribe = set()
+        self._pending_unsubscribe = set()
+        self._subscriptions_flush_scheduled = False
+
+        # subscription keys without clients still subscribed in Redis
+        self.unsubscribe_linger = self.options.redis_unsubscribe_linger
+        self._lingering = TimingWheel()
+        self.linger_check = PeriodicCallback(self.check_lingering, 1000)
+
+        self.presence_gc = self.options.redis_presence_gc
+        self.presence_gc_running = False
+        self.presence_gc_task = PeriodicCallback(
+            self.collect_presence_garbage, self.PRESENCE_GC_INTERVAL
+        )
+
+        self.publisher_batch = CommandBatch(self, lambda: self.publisher)
+        self.worker_batch = CommandBatch(self, lambda: self.worker)
+
+    @property
+    def worker(self):
+        """
+        Connected worker connection with least amount of commands waiting
+        for reply.
+        """
+        workers = [x for x in self.workers if x.is_connected()] or self.workers
+        return min(workers, key=lambda x: len(x.callbacks))
 
     def initialize(self):
         self.connect()
+        if self.unsubscribe_linger:
+            self.linger_check.start()
+        if self.presence_gc:
+            self.presence_gc_task.start()
         logger.info("Redis engine at {0}:{1} (db {2})".format(self.host, self.port, self.db))
         if self.options.redis_api:
             logger.info(
@@ -130,13 +334,14 @@ class Engine(BaseEngine):
             self._need_reconnect = True
             return
 
-        self.subscriber.subscribe(self.admin_channel_name, callback=self.on_redis_message)
-        self.subscriber.subscribe(self.control_channel_name, callback=self.on_redis_message)
+        # all actual subscriptions will be sent now
+        self._pending_subscribe.clear()
+        self._pending_unsubscribe.clear()
+        self._lingering.clear()
 
-        for subscription in self.subscriptions.copy():
-            if subscription not in self.subscriptions:
-                continue
-            self.subscriber.subscribe(subscription, callback=self.on_redis_message)
+        channels = [self.admin_channel_name, self.control_channel_name]
+        channels.extend(self.subscriptions)
+        self.send_subscribe(channels)
 
     @coroutine
     def process_api_messages(self):
@@ -159,13 +364,74 @@ class Engine(BaseEngine):
             logger.error("select database failed: {0}".format(res))
             self._need_reconnect = True
 
+    def on_worker_select(self, worker, res):
+        if res != self.OK_RESPONSE:
+            logger.error("select database failed: {0}".format(res))
+            self._need_reconnect = True
+            return
+
+        self.load_scripts(worker)
+
+    def load_scripts(self, worker):
+        """
+        Load Lua scripts into Redis script cache to call them using EVALSHA.
+        """
+        for script in self.SCRIPTS:
+            worker.script_load(script.source)
+
+    @coroutine
+    def call_script(self, script, keys, args):
+        """
+        Call Lua script using EVALSHA. If Redis does not know script (for
+        example after Redis restart) fall back to EVAL which also puts
+        script into cache.
+        """
+        results, error = yield self.call_script_many(script, [(keys, args)])
+        if error:
+            raise Return((None, error))
+
+        result = results[0]
+        if isinstance(result, Exception):
+            raise Return((None, result))
+
+        raise Return((result, None))
+
+    @coroutine
+    def call_script_many(self, script, calls):
+        """
+        Call Lua script for every (keys, args) pair in one pipeline. Errors
+        of separate calls returned as exceptions in results list.
+        """
+        commands = [[len(keys)] + keys + args for keys, args in calls]
+        results, error = yield Task(
+            self.worker_batch.add, [["EVALSHA", script.sha] + x for x in commands]
+        )
+        if error:
+            raise Return((None, error))
+
+        results = list(results)
+        missing = [
+            i for i, result in enumerate(results)
+            if isinstance(result, Exception) and str(result).startswith('NOSCRIPT')
+        ]
+        if missing:
+            retry_results, error = yield Task(
+                self.worker_batch.add, [["EVAL", script.source] + commands[i] for i in missing]
+            )
+            if error:
+                raise Return((None, error))
+            for i, result in zip(missing, retry_results):
+                results[i] = result
+
+        raise Return((results, None))
+
     def connect(self):
         """
         Connect from scratch if connection not established.
         """
         subscriber_connect = False
         publisher_connect = False
-        worker_connect = False
+        workers_to_connect = []
         listener_connect = False
         try:
             if not self.subscriber.is_connected():
@@ -174,9 +440,11 @@ class Engine(BaseEngine):
             if not self.publisher.is_connected():
                 publisher_connect = True
                 self.publisher.connect(host=self.host, port=self.port)
-            if not self.worker.is_connected():
-                worker_connect = True
-                self.worker.connect(host=self.host, port=self.port)
+            for worker in self.workers:
+                if not worker.is_connected():
+                    workers_to_connect.append(worker)
+                    self._worker_pings.pop(worker, None)
+                    worker.connect(host=self.host, port=self.port)
             if self.options.redis_api:
                 if not self.listener.is_connected():
                     listener_connect = True
@@ -189,8 +457,8 @@ class Engine(BaseEngine):
                     self.subscriber.auth(self.password, callback=self.on_auth)
                 if publisher_connect:
                     self.publisher.auth(self.password, callback=self.on_auth)
-                if worker_connect:
-                    self.worker.auth(self.password, callback=self.on_auth)
+                for worker in workers_to_connect:
+                    worker.auth(self.password, callback=self.on_auth)
                 if self.options.redis_api:
                     if listener_connect:
                         self.listener.auth(self.password, callback=self.on_auth)
@@ -199,8 +467,8 @@ class Engine(BaseEngine):
                 self.subscriber.select(self.db, callback=self.on_subscriber_select)
             if publisher_connect:
                 self.publisher.select(self.db, callback=self.on_select)
-            if worker_connect:
-                self.worker.select(self.db, callback=self.on_select)
+            for worker in workers_to_connect:
+                worker.select(self.db, callback=partial(self.on_worker_select, worker))
             if self.options.redis_api:
                 if listener_connect:
                     self.listener.select(self.db, callback=self.on_listener_select)
@@ -209,11 +477,13 @@ class Engine(BaseEngine):
         self.connection_check.start()
 
     def check_connection(self):
+        self.check_workers()
+
         conn_statuses = [
             self.subscriber.is_connected(),
-            self.publisher.is_connected(),
-            self.worker.is_connected()
+            self.publisher.is_connected()
         ]
+        conn_statuses.extend(worker.is_connected() for worker in self.workers)
         if self.options.redis_api:
             conn_statuses.append(self.listener.is_connected())
 
@@ -223,37 +493,56 @@ class Engine(BaseEngine):
             self._need_reconnect = False
             self.connect()
 
+    def check_workers(self):
+        """
+        Send health check PING into every worker connection, close
+        connections which did not reply on previous PING in time.
+        """
+        now = time.time()
+        for worker in self.workers:
+            if not worker.is_connected():
+                continue
+            sent_at = self._worker_pings.get(worker)
+            if sent_at is None:
+                self._worker_pings[worker] = now
+                worker.ping(callback=partial(self.on_worker_pong, worker))
+            elif now - sent_at > self.WORKER_PING_TIMEOUT:
+                logger.error("Redis worker connection does not respond, closing it")
+                del self._worker_pings[worker]
+                try:
+                    worker.close()
+                except Exception as e:
+                    logger.error(e)
+
+    def on_worker_pong(self, worker, res):
+        self._worker_pings.pop(worker, None)
+
+    @coroutine
     def _publish(self, channel, message):
-        try:
-            self.publisher.publish(channel, message)
-        except StreamClosedError as e:
-            self._need_reconnect = True
-            logger.error(e)
-            return False
-        else:
-            return True
+        _, error = yield Task(self.publisher_batch.add, [["PUBLISH", channel, message]])
+        if error:
+            raise Return((False, error))
+        raise Return((True, None))
 
     @coroutine
     def publish_message(self, channel, body, method="message"):
         """
         Publish message into channel of stream.
         """
-        response = Response()
-        response.method = method
-        response.body = body
-        to_publish = response.as_message()
-        result = self._publish(channel, to_publish)
-        raise Return((result, None))
+        result, error = yield self._publish(channel, self.encode_response(body, method))
+        raise Return((result, error))
 
     @coroutine
     def publish_control_message(self, message):
-        result = self._publish(self.control_channel_name, json_encode(message))
-        raise Return((result, None))
+        result, error = yield self._publish(self.control_channel_name, json_encode(message))
+        raise Return((result, error))
 
     @coroutine
     def publish_admin_message(self, message):
-        result = self._publish(self.admin_channel_name, json_encode(message))
-        raise Return((result, None))
+        result, error = yield self._publish(
+            self.admin_channel_name, self.encode_message(message)
+        )
+        raise Return((result, error))
 
     @coroutine
     def on_api_message(self, redis_message):
@@ -304,15 +593,17 @@ class Engine(BaseEngine):
             return
 
         channel = redis_message[1]
+        data = redis_message[2]
         if six.PY3:
             channel = channel.decode()
+            data = data.decode()
 
         if channel == self.control_channel_name:
-            yield self.handle_control_message(json_decode(redis_message[2]))
+            yield self.handle_control_message(json_decode(data))
         elif channel == self.admin_channel_name:
-            yield self.handle_admin_message(redis_message[2])
+            yield self.handle_admin_message(data)
         else:
-            yield self.handle_message(channel, redis_message[2])
+            yield self.handle_message(channel, data)
 
     @coroutine
     def handle_admin_message(self, message):
@@ -349,36 +640,90 @@ class Engine(BaseEngine):
 
     @coroutine
     def handle_message(self, channel, message_data):
-        if channel not in self.subscriptions:
-            raise Return((True, None))
-
-        timer = None
-        if self.application.collector:
-            timer = self.application.collector.get_timer('broadcast')
+        result, error = yield self.broadcast(channel, message_data)
+        raise Return((result, error))
 
-        for uid, client in six.iteritems(self.subscriptions[channel]):
-            if channel in self.subscriptions and uid in self.subscriptions[channel]:
-                yield client.send(message_data)
+    def send_subscribe(self, channels):
+        for i in range_func(0, len(channels), self.SUBSCRIBE_BATCH_SIZE):
+            self.subscriber.subscribe(
+                channels[i:i + self.SUBSCRIBE_BATCH_SIZE], callback=self.on_redis_message
+            )
 
-        if timer:
-            timer.stop()
+    def send_unsubscribe(self, channels):
+        for i in range_func(0, len(channels), self.SUBSCRIBE_BATCH_SIZE):
+            self.subscriber.unsubscribe(channels[i:i + self.SUBSCRIBE_BATCH_SIZE])
 
     def subscribe_key(self, subscription_key):
-        self.subscriber.subscribe(
-            subscription_key, callback=self.on_redis_message
-        )
+        """
+        Subscribe on subscription key in next SUBSCRIBE command.
+        """
+        if subscription_key in self._pending_unsubscribe:
+            # still subscribed in Redis
+            self._pending_unsubscribe.discard(subscription_key)
+            return
+        self._pending_subscribe.add(subscription_key)
+        self.schedule_subscriptions_flush()
 
     def unsubscribe_key(self, subscription_key):
-        self.subscriber.unsubscribe(subscription_key)
+        """
+        Unsubscribe from subscription key in next UNSUBSCRIBE command.
+        """
+        if subscription_key in self._pending_subscribe:
+            # not subscribed in Redis yet
+            self._pending_subscribe.discard(subscription_key)
+            return
+        self._pending_unsubscribe.add(subscription_key)
+        self.schedule_subscriptions_flush()
+
+    def check_lingering(self):
+        """
+        Unsubscribe from keys nobody subscribed on during linger window.
+        """
+        for subscription_key in self._lingering.expire(time.time()):
+            if subscription_key not in self.subscriptions:
+                self.unsubscribe_key(subscription_key)
+
+    def schedule_subscriptions_flush(self):
+        if not self._subscriptions_flush_scheduled:
+            self._subscriptions_flush_scheduled = True
+            self.io_loop.add_callback(self.flush_subscriptions)
+
+    def flush_subscriptions(self):
+        """
+        Send all subscription changes made during IOLoop iteration in
+        a few multi-channel commands.
+        """
+        self._subscriptions_flush_scheduled = False
+        to_subscribe = list(self._pending_subscribe)
+        to_unsubscribe = list(self._pending_unsubscribe)
+        self._pending_subscribe.clear()
+        self._pending_unsubscribe.clear()
+
+        if not self.subscriber.is_connected():
+            # actual subscriptions will be restored after reconnect
+            return
+
+        try:
+            if to_subscribe:
+                self.send_subscribe(to_subscribe)
+            if to_unsubscribe:
+                self.send_unsubscribe(to_unsubscribe)
+        except StreamClosedError as e:
+            self._need_reconnect = True
+            logger.error(e)
 
     @coroutine
     def add_subscription(self, project_key, channel, client):
 
         subscription_key = self.get_subscription_key(project_key, channel)
-        self.subscribe_key(subscription_key)
 
         if subscription_key not in self.subscriptions:
             self.subscriptions[subscription_key] = {}
+            if subscription_key in self._lingering:
+                # still subscribed in Redis
+                self._lingering.discard(subscription_key)
+            else:
+                self.subscribe_key(subscription_key)
 
         self.subscriptions[subscription_key][client.uid] = client
 
@@ -386,20 +731,30 @@ class Engine(BaseEngine):
 
     @coroutine
     def remove_subscription(self, project_key, channel, client):
+        result, error = yield self.remove_subscription_many([(project_key, channel, client)])
+        raise Return((result, error))
 
-        subscription_key = self.get_subscription_key(project_key, channel)
+    @coroutine
+    def remove_subscription_many(self, subscriptions):
 
-        try:
-            del self.subscriptions[subscription_key][client.uid]
-        except KeyError:
-            pass
+        for project_key, channel, client in subscriptions:
 
-        try:
-            if not self.subscriptions[subscription_key]:
-                self.unsubscribe_key(subscription_key)
-                del self.subscriptions[subscription_key]
-        except KeyError:
-            pass
+            subscription_key = self.get_subscription_key(project_key, channel)
+
+            try:
+                del self.subscriptions[subscription_key][client.uid]
+            except KeyError:
+                pass
+
+            try:
+                if not self.subscriptions[subscription_key]:
+                    del self.subscriptions[subscription_key]
+                    if self.unsubscribe_linger:
+                        self._lingering.add(subscription_key, time.time() + self.unsubscribe_linger)
+                    else:
+                        self.unsubscribe_key(subscription_key)
+            except KeyError:
+                pass
 
         raise Return((True, None))
 
@@ -409,6 +764,61 @@ class Engine(BaseEngine):
     def get_presence_set_key(self, project_key, channel):
         return "%s.presence.set.%s.%s" % (self.prefix, project_key, channel)
 
+    def get_presence_gc_lock_key(self):
+        return "%s.presence.gc.lock" % self.prefix
+
+    @coroutine
+    def collect_presence_garbage(self):
+        """
+        Walk over all presence keys using SCAN and remove expired presence
+        entries. Lock in Redis lives during whole collection interval so
+        only one node collects garbage every interval.
+        """
+        if self.presence_gc_running:
+            raise Return((True, None))
+
+        self.presence_gc_running = True
+        try:
+            results, error = yield Task(self.worker_batch.add, [[
+                "SET", self.get_presence_gc_lock_key(), self.application.uid,
+                "NX", "PX", self.PRESENCE_GC_INTERVAL
+            ]])
+            if error:
+                raise Return((None, error))
+            if results[0] != self.OK_RESPONSE:
+                # other node collects garbage during this interval
+                raise Return((False, None))
+
+            set_prefix = "%s.presence.set." % self.prefix
+            hash_prefix = "%s.presence.hash." % self.prefix
+            cursor = 0
+            while True:
+                results, error = yield Task(self.worker_batch.add, [[
+                    "SCAN", cursor, "MATCH", set_prefix + "*", "COUNT", self.PRESENCE_GC_SCAN_COUNT
+                ]])
+                if error:
+                    raise Return((None, error))
+
+                cursor, keys = results[0]
+                if keys:
+                    now = int(time.time())
+                    calls = []
+                    for set_key in keys:
+                        set_key = set_key.decode()
+                        hash_key = hash_prefix + set_key[len(set_prefix):]
+                        calls.append(([set_key, hash_key], [now]))
+                    _, error = yield self.call_script_many(self.EXPIRE_PRESENCE_SCRIPT, calls)
+                    if error:
+                        raise Return((None, error))
+
+                if int(cursor) == 0:
+                    break
+                yield sleep(self.PRESENCE_GC_SCAN_DELAY)
+        finally:
+            self.presence_gc_running = False
+
+        raise Return((True, None))
+
     def get_history_list_key(self, project_key, channel):
         return "%s.history.list.%s.%s" % (self.prefix, project_key, channel)
 
@@ -418,73 +828,102 @@ class Engine(BaseEngine):
         expire_at = now + (presence_timeout or self.presence_timeout)
         hash_key = self.get_presence_hash_key(project_key, channel)
         set_key = self.get_presence_set_key(project_key, channel)
-        try:
-            pipeline = self.worker.pipeline()
-            pipeline.multi()
-            pipeline.zadd(set_key, {uid: expire_at})
-            pipeline.hset(hash_key, uid, json_encode(user_info))
-            pipeline.execute()
-            yield Task(pipeline.send)
-        except StreamClosedError as e:
-            raise Return((None, e))
-        else:
-            raise Return((True, None))
+        _, error = yield self.call_script(
+            self.ADD_PRESENCE_SCRIPT, [set_key, hash_key],
+            [expire_at, uid, json_encode(user_info)]
+        )
+        if error:
+            raise Return((None, error))
+        raise Return((True, None))
+
+    @coroutine
+    def add_presence_many(self, presences):
+        expire_at = int(time.time()) + self.presence_timeout
+        calls = []
+        for project_key, channel, uid, user_info in presences:
+            hash_key = self.get_presence_hash_key(project_key, channel)
+            set_key = self.get_presence_set_key(project_key, channel)
+            calls.append(([set_key, hash_key], [expire_at, uid, json_encode(user_info)]))
+        results, error = yield self.call_script_many(self.ADD_PRESENCE_SCRIPT, calls)
+        if error:
+            raise Return((None, error))
+        errors = [x for x in results if isinstance(x, Exception)]
+        if errors:
+            raise Return((None, errors[0]))
+        raise Return((True, None))
 
     @coroutine
     def remove_presence(self, project_key, channel, uid):
-        hash_key = self.get_presence_hash_key(project_key, channel)
-        set_key = self.get_presence_set_key(project_key, channel)
-        try:
-            pipeline = self.worker.pipeline()
-            pipeline.hdel(hash_key, uid)
-            pipeline.zrem(set_key, uid)
-            yield Task(pipeline.send)
-        except StreamClosedError as e:
-            raise Return((None, e))
-        else:
-            raise Return((True, None))
+        result, error = yield self.remove_presence_many([(project_key, channel, uid)])
+        raise Return((result, error))
+
+    @coroutine
+    def remove_presence_many(self, presences):
+        commands = []
+        for project_key, channel, uid in presences:
+            hash_key = self.get_presence_hash_key(project_key, channel)
+            set_key = self.get_presence_set_key(project_key, channel)
+            commands.append(["HDEL", hash_key, uid])
+            commands.append(["ZREM", set_key, uid])
+        _, error = yield Task(self.worker_batch.add, commands)
+        if error:
+            raise Return((None, error))
+        raise Return((True, None))
 
     @coroutine
     def get_presence(self, project_key, channel):
         now = int(time.time())
         hash_key = self.get_presence_hash_key(project_key, channel)
         set_key = self.get_presence_set_key(project_key, channel)
-        try:
-            expired_keys = yield Task(self.worker.zrangebyscore, set_key, 0, now)
-            if expired_keys:
-                pipeline = self.worker.pipeline()
-                pipeline.zremrangebyscore(set_key, 0, now)
-                pipeline.hdel(hash_key, [x.decode() for x in expired_keys])
-                yield Task(pipeline.send)
-            data = yield Task(self.worker.hgetall, hash_key)
-        except StreamClosedError as e:
-            raise Return((None, e))
-        else:
-            raise Return((dict_from_list(data), None))
+        data, error = yield self.call_script(
+            self.GET_PRESENCE_SCRIPT, [set_key, hash_key], [now]
+        )
+        if error:
+            raise Return((None, error))
+        raise Return((dict_from_list(data), None))
 
     @coroutine
     def add_history_message(self, project_key, channel, message, history_size, history_lifetime):
         history_list_key = self.get_history_list_key(project_key, channel)
-        try:
-            pipeline = self.worker.pipeline()
-            pipeline.lpush(history_list_key, json_encode(message))
-            pipeline.ltrim(history_list_key, 0, history_size - 1)
-            if history_lifetime:
-                pipeline.expire(history_list_key, history_lifetime)
-            else:
-                pipeline.persist(history_list_key)
-            yield Task(pipeline.send)
-        except StreamClosedError as e:
-            raise Return((None, e))
+        if isinstance(message, Envelope):
+            message = message.encoded
         else:
-            raise Return((True, None))
+            message = json_encode(message)
+        commands = [
+            ["LPUSH", history_list_key, message],
+            ["LTRIM", history_list_key, 0, history_size - 1]
+        ]
+        if history_lifetime:
+            commands.append(["EXPIRE", history_list_key, history_lifetime])
+        else:
+            commands.append(["PERSIST", history_list_key])
+        _, error = yield Task(self.worker_batch.add, commands)
+        if error:
+            raise Return((None, error))
+        raise Return((True, None))
 
     @coroutine
-    def get_history(self, project_key, channel):
+    def get_history(self, project_key, channel, limit=None, offset=0, raw=False):
         history_list_key = self.get_history_list_key(project_key, channel)
-        try:
-            data = yield Task(self.worker.lrange, history_list_key, 0, -1)
-        except StreamClosedError as e:
-            raise Return((None, e))
-        else:
-            raise Return(([json_decode(x.decode()) for x in data], None))
+        end = offset + limit - 1 if limit else -1
+        results, error = yield Task(self.worker_batch.add, [
+            ["LRANGE", history_list_key, offset, end]
+        ])
+        if error:
+            raise Return((None, error))
+        if raw:
+            # messages stored encoded so no need to decode them
+            raise Return((RawJSON.from_list(x.decode() for x in results[0]), None))
+        raise Return(([json_decode(x.decode()) for x in results[0]], None))
+
+    @coroutine
+    def get_history_since(self, project_key, channel, since):
+        history_list_key = self.get_history_list_key(project_key, channel)
+        result, error = yield self.call_script(
+            self.HISTORY_SINCE_SCRIPT, [history_list_key], [since, self.HISTORY_SINCE_CHUNK_SIZE]
+        )
+        if error:
+            raise Return((None, error))
+        recovered = bool(result[0])
+        messages = [json_decode(x.decode()) for x in result[1:]]
+        raise Return(((messages, recovered), None))
@@ -1,24 +1,46 @@
 # coding: utf-8
 # Copyright (c) Alexandr Emelin. MIT license.
 
+import re
 import six
+import math
 import time
+import struct
 import socket
 import logging
-from functools import wraps
+from functools import wraps, partial
 from collections import defaultdict
 
+from six.moves import cPickle as pickle
+from tornado.iostream import IOStream, StreamClosedError, StreamBufferFullError
+
 
 logger = logging.getLogger('metrics')
 
 
+PROMETHEUS_NAME_RE = re.compile(r"[^a-zA-Z0-9_]")
+
+
+try:
+    # monotonic clock with highest available resolution
+    clock = time.perf_counter
+except AttributeError:
+    # python 2 - use monotonic package when installed
+    try:
+        from monotonic import monotonic as clock
+    except ImportError:
+        from tornado.platform.auto import monotonic_time
+        # wall clock as last resort
+        clock = monotonic_time or time.time
+
+
 class MetricError(Exception):
     pass
 
 
 class Timer(object):
     """
-    Measure time interval between events
+    Measure time interval between events in microseconds
     """
 
     def __init__(self, collector, metric):
@@ -44,14 +66,14 @@ class Timer(object):
     def start(self):
         self.interval = None
         self._sent = False
-        self._start_time = time.time()
+        self._start_time = clock()
         return self
 
     def stop(self, send=True):
         if self._start_time is None:
             raise MetricError("Can not stop - timer not started")
-        delta = time.time() - self._start_time
-        self.interval = int(round(1000 * delta))  # to milliseconds.
+        delta = clock() - self._start_time
+        self.interval = int(round(1000000 * delta))  # to microseconds.
         if send:
             self.send()
         return self.interval
@@ -65,6 +87,85 @@ class Timer(object):
         self.collector.timing(self.metric, self.interval)
 
 
+class Histogram(object):
+    """
+    Fixed memory histogram of recorded values. Values below 2 ** PRECISION
+    kept exactly, bigger values go into logarithmic buckets each holding
+    values with the same PRECISION highest bits - so reported percentiles
+    have relative error less than 1%.
+    """
+
+    PRECISION = 8
+
+    PERCENTILES = (
+        ("p50", 50),
+        ("p90", 90),
+        ("p99", 99),
+        ("p999", 99.9)
+    )
+
+    def __init__(self):
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def get_bucket(cls, value):
+        value = max(int(value), 0)
+        exact = 1 << cls.PRECISION
+        if value < exact:
+            return value
+        # bit length of value, int.bit_length is not available in Python 2.6
+        shift = len(bin(value)) - 2 - cls.PRECISION
+        half = exact >> 1
+        return exact + (shift - 1) * half + (value >> shift) - half
+
+    @classmethod
+    def get_bucket_max(cls, bucket):
+        """
+        Return highest value which goes into bucket.
+        """
+        exact = 1 << cls.PRECISION
+        if bucket < exact:
+            return bucket
+        half = exact >> 1
+        shift = (bucket - exact) // half + 1
+        mantissa = (bucket - exact) % half + half
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, value):
+        self.buckets[self.get_bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for bucket, count in six.iteritems(other.buckets):
+            self.buckets[bucket] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        target = max(int(math.ceil(self.count * percent / 100.0)), 1)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return min(self.get_bucket_max(bucket), self.max)
+        return self.max
+
+
 class Collector(object):
     """
     Class to collect and aggregate statistical metrics.
@@ -79,6 +180,10 @@ class Collector(object):
         self._times = None
         self._gauges = None
         self._last_reset = None
+        # values collected since start, interval values merged on reset
+        self._total_counters = defaultdict(int)
+        self._total_times = defaultdict(Histogram)
+        self._total_gauges = {}
         self.reset()
 
     def get(self):
@@ -97,48 +202,81 @@ class Collector(object):
         for metric, value in six.iteritems(self._gauges):
             to_return[metric] = value
 
-        for metric, intervals in six.iteritems(self._times):
-            prepared_timing_data = self.prepare_timing_data(intervals)
+        for metric, histogram in six.iteritems(self._times):
+            prepared_timing_data = self.prepare_timing_data(histogram)
             for key, value in six.iteritems(prepared_timing_data):
                 to_return[metric + self.sep + key] = value
 
         return to_return
 
     @classmethod
-    def prepare_timing_data(cls, intervals):
-        min_interval = intervals[0]
-        max_interval = 0
-        avg_interval = 0
-        total = 0
-        count = 0
-        for interval in intervals:
-            interval = float(interval)
-            count += 1
-            total += interval
-            if interval > max_interval:
-                max_interval = interval
-            if interval < min_interval:
-                min_interval = interval
-        if count:
-            avg_interval = round(total / count, 2)
-
-        return {
-            "min": min_interval,
-            "max": max_interval,
-            "avg": avg_interval,
-            "count": count
+    def prepare_timing_data(cls, histogram):
+        to_return = {
+            "min": histogram.min or 0,
+            "max": histogram.max or 0,
+            "avg": round(float(histogram.total) / histogram.count, 2) if histogram.count else 0,
+            "count": histogram.count
         }
+        for key, percent in histogram.PERCENTILES:
+            to_return[key] = histogram.percentile(percent)
+        return to_return
+
+    def merge_totals(self):
+        for metric, value in six.iteritems(self._counters):
+            self._total_counters[metric] += value
+        for metric, histogram in six.iteritems(self._times):
+            self._total_times[metric].merge(histogram)
+        self._total_gauges.update(self._gauges)
+
+    def iter_prometheus(self, gauges=None, namespace="centrifuge"):
+        """
+        Yield metrics in Prometheus text exposition format. Counters and
+        timers reported as totals since start, collector is not reset.
+        """
+        counters = defaultdict(int, self._total_counters)
+        for metric, value in six.iteritems(self._counters):
+            counters[metric] += value
+        for metric in sorted(counters):
+            name = self.get_prometheus_name(namespace, metric) + "_total"
+            yield "# TYPE {0} counter\n{0} {1}\n".format(name, counters[metric])
+
+        all_gauges = dict(self._total_gauges)
+        all_gauges.update(self._gauges)
+        all_gauges.update(gauges or {})
+        for metric in sorted(all_gauges):
+            name = self.get_prometheus_name(namespace, metric)
+            yield "# TYPE {0} gauge\n{0} {1}\n".format(name, all_gauges[metric])
+
+        for metric in sorted(set(self._total_times) | set(self._times)):
+            histogram = Histogram()
+            if metric in self._total_times:
+                histogram.merge(self._total_times[metric])
+            if metric in self._times:
+                histogram.merge(self._times[metric])
+            name = self.get_prometheus_name(namespace, metric) + "_microseconds"
+            lines = ["# TYPE {0} summary".format(name)]
+            for _, percent in histogram.PERCENTILES:
+                lines.append('{0}{{quantile="{1:g}"}} {2}'.format(
+                    name, percent / 100.0, histogram.percentile(percent)
+                ))
+            lines.append("{0}_sum {1}".format(name, histogram.total))
+            lines.append("{0}_count {1}".format(name, histogram.count))
+            yield "\n".join(lines) + "\n"
+
+    @staticmethod
+    def get_prometheus_name(namespace, metric):
+        return PROMETHEUS_NAME_RE.sub("_", namespace + "_" + metric)
 
     def reset(self):
+        if self._counters is not None:
+            self.merge_totals()
         self._counters = defaultdict(int)
-        self._times = defaultdict(list)
+        self._times = defaultdict(Histogram)
         self._gauges = defaultdict(int)
         self._last_reset = time.time()
 
     def timing(self, metric, interval):
-        if metric not in self._times:
-            self._times[metric] = []
-        self._times[metric].append(interval)
+        self._times[metric].record(interval)
 
     def increment(self, metric, incr_by=1):
         if metric not in self._counters:
@@ -162,22 +300,28 @@ class Collector(object):
         return timer
 
 
-class Exporter(object):
+class BaseExporter(object):
     """
-    Export collected metrics into Graphite
+    Base class for exporters of collected metrics into Graphite
     """
 
     SEP = "."
 
-    def __init__(self, host, port, prefix=None, sep=None, max_udp_size=512):
+    # in bytes, maximum size of UDP datagram
+    MAX_UDP_SIZE = 512
+
+    # in bytes, maximum size of data waiting to be sent over TCP
+    MAX_BUFFER_SIZE = 1048576
+
+    def __init__(self, host, port, prefix=None, sep=None, max_udp_size=None,
+                 max_buffer_size=None, io_loop=None):
         self.host = host
         self.port = port
         self.prefix = prefix or ""
         self.sep = sep or self.SEP
-        self._address = (socket.gethostbyname(host), port)
-        self.max_udp_size = max_udp_size
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.setblocking(0)
+        self.max_udp_size = max_udp_size or self.MAX_UDP_SIZE
+        self.max_buffer_size = max_buffer_size or self.MAX_BUFFER_SIZE
+        self.io_loop = io_loop
 
     def get_key(self, metric):
         if not self.prefix:
@@ -187,32 +331,132 @@ class Exporter(object):
         else:
             return self.prefix + self.sep + metric
 
-    def prepare_metrics(self, metrics):
-        to_return = []
+    def iter_metrics(self, metrics):
         timestamp = int(time.time())
         for metric, value in six.iteritems(metrics):
-            to_return.append('{0} {1} {2}'.format(self.get_key(metric), int(value), timestamp))
-        return to_return
+            yield self.get_key(metric), int(value), timestamp
+
+    def prepare_metrics(self, metrics):
+        return ['{0} {1} {2}'.format(*x) for x in self.iter_metrics(metrics)]
 
     def export(self, metrics):
-        if not metrics:
-            return
+        """
+        Send collected metrics into Graphite.
+        """
+        pass
+
 
-        prepared_metrics = self.prepare_metrics(metrics)
+class Exporter(BaseExporter):
+    """
+    Export collected metrics into Graphite via UDP
+    """
 
-        data = prepared_metrics.pop(0)
-        while prepared_metrics:
-            stat = prepared_metrics.pop(0)
-            if len(stat) + len(data) + 1 >= self.max_udp_size:
-                self.send(data)
-                data = stat
-            else:
-                data += '\n' + stat
+    def __init__(self, *args, **kwargs):
+        super(Exporter, self).__init__(*args, **kwargs)
+        self._address = (socket.gethostbyname(self.host), self.port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(0)
 
-        self.send(data)
+    def pack(self, stats):
+        """
+        Join stats into datagrams not bigger than max_udp_size.
+        """
+        chunk = []
+        size = 0
+        for stat in stats:
+            # size of chunk includes newline after every stat
+            if chunk and size + len(stat) > self.max_udp_size:
+                yield '\n'.join(chunk)
+                chunk = []
+                size = 0
+            chunk.append(stat)
+            size += len(stat) + 1
+        if chunk:
+            yield '\n'.join(chunk)
+
+    def export(self, metrics):
+        if not metrics:
+            return
+
+        for data in self.pack(self.prepare_metrics(metrics)):
+            self.send(data)
 
     def send(self, data):
         try:
             self.socket.sendto(data.encode('ascii'), self._address)
         except Exception as err:
             logger.exception(err)
+
+
+class TCPExporter(BaseExporter):
+    """
+    Export collected metrics into Graphite over persistent TCP connection
+    using plaintext protocol. Connection reestablished on next export if
+    closed. Data not sent yet is limited by max_buffer_size - when Graphite
+    can't receive metrics fast enough new metrics are dropped.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TCPExporter, self).__init__(*args, **kwargs)
+        self.stream = None
+
+    def get_stream(self):
+        if self.stream is None or self.stream.closed():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.stream = IOStream(
+                sock, io_loop=self.io_loop, max_write_buffer_size=self.max_buffer_size
+            )
+            self.stream.set_close_callback(partial(self.on_close, self.stream))
+            self.stream.connect((self.host, self.port))
+        return self.stream
+
+    @staticmethod
+    def on_close(stream):
+        if stream.error:
+            logger.error("Graphite connection closed: {0}".format(stream.error))
+
+    def encode(self, metrics):
+        """
+        Return list of byte chunks to send.
+        """
+        return [('\n'.join(self.prepare_metrics(metrics)) + '\n').encode('ascii')]
+
+    def export(self, metrics):
+        if not metrics:
+            return
+
+        stream = self.get_stream()
+        for data in self.encode(metrics):
+            try:
+                stream.write(data)
+            except StreamBufferFullError:
+                logger.error("Graphite send buffer is full, metrics dropped")
+                return
+            except StreamClosedError as err:
+                logger.error(err)
+                return
+
+
+class PickleExporter(TCPExporter):
+    """
+    Export collected metrics into Graphite over persistent TCP connection
+    using pickle protocol.
+    """
+
+    # how many metrics sent in one pickled message
+    BATCH_SIZE = 500
+
+    def encode(self, metrics):
+        items = [(key, (timestamp, value)) for key, value, timestamp in self.iter_metrics(metrics)]
+        chunks = []
+        for i in range(0, len(items), self.BATCH_SIZE):
+            payload = pickle.dumps(items[i:i + self.BATCH_SIZE], protocol=2)
+            chunks.append(struct.pack("!L", len(payload)) + payload)
+        return chunks
+
+
+EXPORTERS = {
+    "udp": Exporter,
+    "tcp": TCPExporter,
+    "pickle": PickleExporter
+}
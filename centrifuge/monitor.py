@@ -0,0 +1,53 @@
+# coding: utf-8
+# Copyright (c) Alexandr Emelin. MIT license.
+
+from tornado.ioloop import IOLoop
+
+from centrifuge.log import logger
+from centrifuge.metrics import clock
+
+
+class LoopMonitor(object):
+    """
+    Measures how late IOLoop runs scheduled callbacks and records this lag
+    into collector as ioloop_lag timer (in microseconds). When blocking
+    threshold set IOLoop also logs stack of callback which blocked it for
+    longer than threshold.
+    """
+
+    METRIC = 'ioloop_lag'
+
+    # in milliseconds, how often lag measured
+    DEFAULT_INTERVAL = 500
+
+    def __init__(self, collector, interval=None, blocking_threshold=None, io_loop=None):
+        self.collector = collector
+        self.io_loop = io_loop or IOLoop.instance()
+        self.interval = (interval or self.DEFAULT_INTERVAL) / 1000.0
+        # in milliseconds, 0 or None to disable blocking detection
+        self.blocking_threshold = blocking_threshold
+        self.timeout = None
+        self.expected = None
+
+    def start(self):
+        if self.blocking_threshold:
+            self.io_loop.set_blocking_log_threshold(self.blocking_threshold / 1000.0)
+        self.schedule()
+
+    def stop(self):
+        if self.timeout is not None:
+            self.io_loop.remove_timeout(self.timeout)
+            self.timeout = None
+        if self.blocking_threshold:
+            self.io_loop.set_blocking_log_threshold(None)
+
+    def schedule(self):
+        self.expected = clock() + self.interval
+        self.timeout = self.io_loop.add_timeout(self.io_loop.time() + self.interval, self.check)
+
+    def check(self):
+        lag = max(clock() - self.expected, 0)
+        self.collector.timing(self.METRIC, int(round(lag * 1000000)))
+        if self.blocking_threshold and lag * 1000 > self.blocking_threshold:
+            logger.warning("IOLoop lag {0:.3f} seconds".format(lag))
+        self.schedule()
@@ -75,6 +75,7 @@ from centrifuge.handlers import SockjsConnection
 from centrifuge.handlers import Client
 
 from centrifuge.web.handlers import InfoHandler
+from centrifuge.web.handlers import MetricsHandler
 from centrifuge.web.handlers import AuthHandler
 from centrifuge.web.handlers import AdminWebSocketHandler
 from centrifuge.web.handlers import ActionHandler
@@ -93,6 +94,7 @@ def create_application_handlers(sockjs_settings):
     handlers = [
         tornado.web.url(r'/api/([^/]+)/?$', ApiHandler, name="api"),
         tornado.web.url(r'/info/$', InfoHandler, name="info"),
+        tornado.web.url(r'/metrics$', MetricsHandler, name="metrics"),
         tornado.web.url(r'/action/$', ActionHandler, name="action"),
         tornado.web.url(r'/auth/$', AuthHandler, name="auth"),
         (r'/socket', AdminWebSocketHandler),
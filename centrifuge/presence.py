@@ -0,0 +1,73 @@
+# coding: utf-8
+# Copyright (c) Alexandr Emelin. MIT license.
+
+import six
+from tornado.ioloop import PeriodicCallback, IOLoop
+from tornado.gen import coroutine, Return
+
+from centrifuge.log import logger
+
+
+class PresenceScheduler(object):
+    """
+    Refreshes presence information of all node connections. Connections
+    are spread evenly over slots, every tick takes next slot and sends
+    presence of its connections into engine in one call. So every
+    connection refreshed once per presence ping interval without having
+    its own periodic callback.
+    """
+
+    # in milliseconds, how often next slot processed
+    TICK_INTERVAL = 1000
+
+    def __init__(self, application, io_loop=None):
+        self.application = application
+        self.io_loop = io_loop or IOLoop.instance()
+        interval = self.application.engine.presence_ping_interval
+        self.slots = [{} for _ in range(max(int(interval // self.TICK_INTERVAL), 1))]
+        # client uid mapped to slot index
+        self.client_slots = {}
+        # index of slot to process on next tick
+        self.current = 0
+        # index of slot to put next client into
+        self.next_slot = 0
+        self.periodic = PeriodicCallback(self.tick, self.TICK_INTERVAL, io_loop=self.io_loop)
+
+    def start(self):
+        self.periodic.start()
+
+    def stop(self):
+        self.periodic.stop()
+
+    def __len__(self):
+        return len(self.client_slots)
+
+    def add(self, client):
+        if client.uid in self.client_slots:
+            return
+        slot = self.next_slot
+        self.next_slot = (self.next_slot + 1) % len(self.slots)
+        self.slots[slot][client.uid] = client
+        self.client_slots[client.uid] = slot
+
+    def remove(self, client):
+        slot = self.client_slots.pop(client.uid, None)
+        if slot is not None:
+            self.slots[slot].pop(client.uid, None)
+
+    @coroutine
+    def tick(self):
+        slot = self.slots[self.current]
+        self.current = (self.current + 1) % len(self.slots)
+
+        presences = []
+        for client in list(six.itervalues(slot)):
+            presences.extend(client.get_presences())
+
+        if not presences:
+            raise Return((True, None))
+
+        result, error = yield self.application.engine.add_presence_many(presences)
+        if error:
+            logger.error("presence refresh failed: {0}".format(error))
+        raise Return((result, error))
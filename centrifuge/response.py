@@ -1,9 +1,40 @@
 # coding: utf-8
 # Copyright (c) Alexandr Emelin. MIT license.
 
+import six
+
 from centrifuge.utils import json_encode
 
 
+class RawJSON(object):
+    """
+    Already encoded JSON fragment - for example messages as they stored in
+    Redis history. Spliced into response as is without decoding.
+    """
+
+    def __init__(self, encoded):
+        self.encoded = encoded
+
+    @classmethod
+    def from_list(cls, fragments):
+        return cls('[%s]' % ','.join(fragments))
+
+
+def json_encode_raw(obj, key):
+    """
+    Encode dict into JSON splicing RawJSON fragment stored under key. Only
+    this key checked so objects without raw fragments encoded with plain
+    json_encode at the same cost.
+    """
+    value = obj.get(key)
+    if not isinstance(value, RawJSON):
+        return json_encode(obj)
+    rest = dict((k, v) for k, v in six.iteritems(obj) if k != key)
+    if not rest:
+        return '{%s:%s}' % (json_encode(key), value.encoded)
+    return '%s,%s:%s}' % (json_encode(rest)[:-1], json_encode(key), value.encoded)
+
+
 class Response(object):
 
     def __init__(self, method=None, error=None, body=None):
@@ -11,8 +42,23 @@ class Response(object):
         self.error = error
         self.body = body
 
+    def is_raw(self):
+        """
+        RawJSON fragment can only appear as whole body or as body data
+        (history).
+        """
+        body = self.body
+        return isinstance(body, RawJSON) or (
+            isinstance(body, dict) and isinstance(body.get('data'), RawJSON)
+        )
+
     def as_message(self):
-        return json_encode(self.as_dict())
+        if not self.is_raw():
+            return json_encode(self.as_dict())
+        message = self.as_dict()
+        if not isinstance(self.body, RawJSON):
+            message['body'] = RawJSON(json_encode_raw(self.body, 'data'))
+        return json_encode_raw(message, 'body')
 
     def as_dict(self):
         return {
@@ -35,7 +81,30 @@ class MultiResponse(object):
             self.add(response)
 
     def as_message(self):
-        return json_encode(self.as_list_of_dicts())
+        if not any(x.is_raw() for x in self.responses):
+            return json_encode(self.as_list_of_dicts())
+        return '[%s]' % ','.join(x.as_message() for x in self.responses)
 
     def as_list_of_dicts(self):
         return [x.as_dict() for x in self.responses]
+
+
+class Envelope(object):
+    """
+    Message encoded into JSON only once. Encoded message is spliced into
+    broadcast responses, admin messages and history.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self.encoded = json_encode(message)
+
+    def as_response(self, method="message"):
+        return '{"method":%s,"error":null,"body":%s}' % (
+            json_encode(method), self.encoded
+        )
+
+    def as_admin_message(self, project_name):
+        return '{"method":"message","body":{"project":%s,"message":%s}}' % (
+            json_encode(project_name), self.encoded
+        )
@@ -103,9 +103,28 @@ server_api_schema = {
         "properties": {
             "channel": {
                 "type": "string"
+            },
+            "limit": {
+                "type": "integer",
+                "minimum": 1
+            },
+            "offset": {
+                "type": "integer",
+                "minimum": 0
+            },
+            "since": {
+                "type": "string"
             }
         },
-        "required": ["channel"]
+        "required": ["channel"],
+        # since returns all messages newer than given one so it can not be
+        # combined with limit and offset
+        "not": {
+            "anyOf": [
+                {"required": ["since", "limit"]},
+                {"required": ["since", "offset"]}
+            ]
+        }
     },
     "unsubscribe": {
         "type": "object",
@@ -155,6 +174,9 @@ client_api_schema = {
             "sign": {
                 "type": "string"
             },
+            "since": {
+                "type": "string"
+            },
         },
         "required": ["channel"]
     },
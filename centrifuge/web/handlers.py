@@ -17,6 +17,7 @@ import centrifuge
 from centrifuge.log import logger
 from centrifuge.utils import json_encode, json_decode
 from centrifuge.handlers import BaseHandler
+from centrifuge.response import json_encode_raw
 
 
 def authenticated(method):
@@ -89,6 +90,21 @@ class InfoHandler(WebBaseHandler):
         self.finish(json_encode(context))
 
 
+class MetricsHandler(BaseHandler):
+    """
+    Node metrics in Prometheus text exposition format.
+    """
+
+    def get(self):
+        if not self.application.prometheus_metrics:
+            raise tornado.web.HTTPError(404)
+        lines = self.application.collector.iter_prometheus(
+            gauges=self.application.get_node_gauges()
+        )
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.finish("".join(lines))
+
+
 class ActionHandler(WebBaseHandler):
 
     @authenticated
@@ -114,10 +130,10 @@ class ActionHandler(WebBaseHandler):
             result, error = yield self.application.process_call(project, method, params)
 
         self.set_header("Content-Type", "application/json")
-        self.finish(json_encode({
+        self.finish(json_encode_raw({
             "body": result,
             "error": error
-        }))
+        }, "body"))
 
 
 class AdminWebSocketHandler(WebSocketHandler):
@@ -0,0 +1,94 @@
+# coding: utf-8
+# Copyright (c) Alexandr Emelin. MIT license.
+
+import heapq
+
+
+class TimingWheel(object):
+    """
+    Index of key deadlines grouped into buckets of `resolution` seconds.
+    Every key has only one deadline, so thousands of deadlines are handled
+    by one periodic sweep instead of IOLoop timeout for each key. Sweep
+    does work proportional to amount of expired keys.
+    """
+
+    def __init__(self, resolution=1):
+        self.resolution = resolution
+        self.deadlines = {}
+        self.buckets = {}
+        # bucket numbers ordered by time, one heap entry per bucket
+        self.heap = []
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def get_bucket(self, deadline):
+        return int(deadline // self.resolution)
+
+    def get(self, key):
+        return self.deadlines.get(key)
+
+    def add(self, key, deadline):
+        """
+        Set deadline for key replacing previous one.
+        """
+        self.discard(key)
+        bucket = self.get_bucket(deadline)
+        keys = self.buckets.get(bucket)
+        if keys is None:
+            keys = self.buckets[bucket] = set()
+            heapq.heappush(self.heap, bucket)
+        keys.add(key)
+        self.deadlines[key] = deadline
+
+    def discard(self, key):
+        deadline = self.deadlines.pop(key, None)
+        if deadline is None:
+            return
+        keys = self.buckets.get(self.get_bucket(deadline))
+        if keys is not None:
+            keys.discard(key)
+
+    def clear(self):
+        self.deadlines = {}
+        self.buckets = {}
+        self.heap = []
+
+    def expire(self, now, limit=None):
+        """
+        Remove and return keys which deadline is not later than now. If
+        limit set no more than limit keys returned - others will be
+        returned by next calls.
+        """
+        expired = []
+        while self.heap:
+            bucket = self.heap[0]
+            if bucket * self.resolution > now:
+                break
+
+            keys = self.buckets[bucket]
+            if (bucket + 1) * self.resolution <= now:
+                # all keys in bucket expired
+                while keys:
+                    if limit is not None and len(expired) >= limit:
+                        return expired
+                    key = keys.pop()
+                    del self.deadlines[key]
+                    expired.append(key)
+            else:
+                for key in [x for x in keys if self.deadlines[x] <= now]:
+                    if limit is not None and len(expired) >= limit:
+                        return expired
+                    keys.discard(key)
+                    del self.deadlines[key]
+                    expired.append(key)
+                if keys:
+                    break
+
+            heapq.heappop(self.heap)
+            del self.buckets[bucket]
+
+        return expired
@@ -0,0 +1,58 @@
+# coding: utf-8
+from tornado.gen import coroutine, Return
+from tornado.testing import AsyncTestCase, gen_test
+
+from centrifuge.cleanup import CleanupQueue
+
+
+class FakeEngine(object):
+
+    def __init__(self):
+        self.removed = []
+        self.published = []
+
+    @coroutine
+    def remove_presence_many(self, presences):
+        self.removed.append(presences)
+        raise Return((True, None))
+
+    @coroutine
+    def publish_message(self, channel, body, method="message"):
+        self.published.append((channel, body, method))
+        raise Return((True, None))
+
+
+class FakeApplication(object):
+
+    settings = {"config": {"cleanup_batch_size": 3}}
+
+    def __init__(self):
+        self.engine = FakeEngine()
+
+
+class CleanupQueueTest(AsyncTestCase):
+
+    @gen_test
+    def test_process(self):
+        application = FakeApplication()
+        queue = CleanupQueue(application, io_loop=self.io_loop)
+        queue.add(
+            [("project", "channel-%d" % i, "uid") for i in range(4)],
+            [("key", {"channel": "channel-0"})]
+        )
+        self.assertEqual(len(queue), 5)
+
+        yield queue.process()
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(len(application.engine.removed[0]), 3)
+        self.assertEqual(application.engine.published, [])
+
+        yield queue.process()
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(len(application.engine.removed[1]), 1)
+        self.assertEqual(
+            application.engine.published, [("key", {"channel": "channel-0"}, "leave")]
+        )
+
+        yield queue.process()
+        self.assertEqual(len(application.engine.removed), 2)
@@ -1,6 +1,6 @@
 # coding: utf-8
 from __future__ import print_function
-from tornado.gen import coroutine, Return
+from tornado.gen import coroutine, Return, sleep
 from tornado.testing import AsyncTestCase, gen_test
 import json
 
@@ -24,30 +24,76 @@ class FakeSock(object):
         return True
 
 
+class FakeStream(object):
+
+    _write_buffer_size = 0
+
+
+class FakeHandler(object):
+
+    def __init__(self):
+        self.stream = FakeStream()
+
+
+class StalledSession(object):
+
+    transport_name = 'test'
+
+    def __init__(self):
+        self.handler = FakeHandler()
+
+
+class StalledSock(object):
+
+    def __init__(self):
+        self.session = StalledSession()
+        self.sent = []
+        self.closed = False
+
+    def send(self, message):
+        self.sent.append(message)
+
+    def close(self):
+        self.closed = True
+
+
 class FakeEngine(Engine):
 
+    presence_calls = 0
+
     @coroutine
     def add_presence(self, *args, **kwargs):
+        self.presence_calls += 1
+        raise Return((True, None))
+
+    @coroutine
+    def add_presence_many(self, presences):
+        self.presence_calls += 1
         raise Return((True, None))
 
     @coroutine
     def remove_presence(self, *args, **kwargs):
+        self.presence_calls += 1
+        raise Return((True, None))
+
+    @coroutine
+    def remove_presence_many(self, presences):
+        self.presence_calls += 1
         raise Return((True, None))
 
 
 class FakeApplication(Application):
 
+    presence = True
+
     def get_project(self, project_key):
         return {'name': 'test'}
 
     def get_namespace(self, project, params):
-        return {'name': 'test', 'anonymous': True, 'join_leave': True}
-
-
-class FakePeriodic(object):
-
-    def stop(self):
-        return True
+        return {
+            'name': 'test', 'anonymous': True, 'join_leave': True, 'presence': self.presence,
+            'history_size': 10, 'history_lifetime': 60
+        }
 
 
 class TestClient(Client):
@@ -68,7 +114,6 @@ class ClientTest(AsyncTestCase):
         self.client.uid = "test_uid"
         self.client.user = "test_user"
         self.client.channels = {}
-        self.client.presence_ping = FakePeriodic()
         self.client.application = FakeApplication()
         self.client.application.engine = FakeEngine(self.client.application)
 
@@ -113,3 +158,125 @@ class ClientTest(AsyncTestCase):
         result, error = yield self.client.clean()
         self.assertEqual(result, True)
         self.assertEqual(error, None)
+
+    @gen_test
+    def test_recover_since(self):
+        engine = self.client.application.engine
+        for uid in ("1", "2", "3"):
+            yield engine.add_history_message(
+                "test", "test", {"uid": uid}, history_size=10, history_lifetime=60
+            )
+
+        result, error = yield self.client.handle_subscribe({"channel": "test", "since": "2"})
+        self.assertEqual(error, None)
+        self.assertEqual(result["messages"], [{"uid": "3"}])
+        self.assertEqual(result["recovered"], True)
+
+        result, error = yield self.client.handle_history({"channel": "test", "since": "0"})
+        self.assertEqual(error, None)
+        self.assertEqual(len(result["data"]), 3)
+        self.assertEqual(result["recovered"], False)
+
+    @gen_test
+    def test_recover_since_error(self):
+        engine = self.client.application.engine
+
+        @coroutine
+        def get_history_since(*args, **kwargs):
+            raise Return((None, "error"))
+
+        engine.get_history_since = get_history_since
+
+        result, error = yield self.client.handle_subscribe({"channel": "test", "since": "2"})
+        self.assertEqual(error, None)
+        self.assertTrue("messages" not in result)
+        self.assertTrue("recovered" not in result)
+
+        result, error = yield self.client.handle_history({"channel": "test", "since": "2"})
+        self.assertEqual(error, self.client.application.INTERNAL_SERVER_ERROR)
+
+    @gen_test
+    def test_presence_disabled(self):
+        self.client.application.presence = False
+        engine = self.client.application.engine
+        params = {"channel": "test"}
+
+        yield self.client.handle_subscribe(params)
+        self.assertEqual(self.client.get_presences(), [])
+        yield self.client.handle_unsubscribe(params)
+        yield self.client.handle_subscribe(params)
+        yield self.client.clean()
+        self.assertEqual(engine.presence_calls, 0)
+
+    @gen_test
+    def test_presence_enabled(self):
+        engine = self.client.application.engine
+        params = {"channel": "test"}
+
+        yield self.client.handle_subscribe(params)
+        presences = self.client.get_presences()
+        self.assertEqual(
+            [x[:3] for x in presences], [(self.client.project_name, "test", self.client.uid)]
+        )
+        yield self.client.handle_unsubscribe(params)
+        self.assertEqual(engine.presence_calls, 2)
+        self.assertEqual(self.client.get_presences(), [])
+
+
+class ClientQueueTest(AsyncTestCase):
+
+    def setUp(self):
+        super(ClientQueueTest, self).setUp()
+        self.sock = StalledSock()
+        self.client = TestClient(self.sock, {})
+        self.client.application = FakeApplication()
+        self.client.application.CLIENT_QUEUE_MAX_MESSAGES = 2
+
+    def test_flush(self):
+        self.assertTrue(self.client.write('1'))
+        self.assertEqual(self.sock.sent, ['1'])
+        self.assertEqual(len(self.client.queue), 0)
+
+        self.sock.session.handler.stream._write_buffer_size = Client.TRANSPORT_BUFFER_LIMIT + 1
+        self.assertTrue(self.client.write('2'))
+        self.assertEqual(self.sock.sent, ['1'])
+        self.assertEqual(self.client.queue_size, 1)
+
+        self.sock.session.handler.stream._write_buffer_size = 0
+        self.client.retry_flush()
+        self.assertEqual(self.sock.sent, ['1', '2'])
+        self.assertEqual(self.client.queue_size, 0)
+        self.client.clear_queue()
+
+    def test_drop_oldest(self):
+        self.client.application.CLIENT_QUEUE_OVERFLOW = 'drop'
+        self.sock.session.handler.stream._write_buffer_size = Client.TRANSPORT_BUFFER_LIMIT + 1
+        for message in ['1', '2', '3']:
+            self.assertTrue(self.client.write(message))
+        self.assertEqual(list(self.client.queue), ['2', '3'])
+        self.assertFalse(self.sock.closed)
+        self.client.clear_queue()
+
+    def test_disconnect_slow(self):
+        self.sock.session.handler.stream._write_buffer_size = Client.TRANSPORT_BUFFER_LIMIT + 1
+        self.assertTrue(self.client.write('1'))
+        self.assertTrue(self.client.write('2'))
+        self.assertFalse(self.client.write('3'))
+        self.assertEqual(len(self.client.queue), 0)
+        self.assertEqual(json.loads(self.sock.sent[-1])["body"], {"reason": "slow"})
+        self.assertTrue(self.sock.closed)
+
+    @gen_test
+    def test_batch_messages(self):
+        self.client.application.CLIENT_BATCH_MESSAGES = True
+        self.client.application.CLIENT_QUEUE_MAX_MESSAGES = 10
+        self.client.write('{"method": "message"}')
+        self.client.write('[{"method": "publish"}, {"method": "history"}]')
+        self.client.write('[]')
+        self.assertEqual(self.sock.sent, [])
+        yield sleep(0.01)
+        self.assertEqual(len(self.sock.sent), 1)
+        frame = json.loads(self.sock.sent[0])
+        self.assertEqual(
+            [x["method"] for x in frame], ["message", "publish", "history"]
+        )
@@ -1,10 +1,11 @@
 # coding: utf-8
 from unittest import main, TestCase
-from tornado.testing import gen_test
+from tornado.testing import AsyncTestCase, gen_test
 from mock import Mock
 import socket
 
 from centrifuge.core import *
+from centrifuge.engine.memory import Engine as MemoryEngine
 
 
 class TestApp(Application):
@@ -51,5 +52,39 @@ class CoreTest(TestCase):
         channel = "$channel"
         self.assertEqual(self.app.is_channel_private(channel), True)
 
+    def test_unknown_graphite_protocol(self):
+        self.app.settings['config'] = {'metrics': {
+            'graphite': True, 'graphite_protocol': 'http',
+            'graphite_host': 'localhost', 'graphite_port': 2003
+        }}
+        self.assertRaises(Exception, self.app.init_metrics)
+
+
+class CoreHistoryTest(AsyncTestCase):
+
+    def setUp(self):
+        super(CoreHistoryTest, self).setUp()
+        self.app = TestApp()
+        self.app.engine = MemoryEngine(self.app, io_loop=self.io_loop)
+        self.project = {'name': 'test'}
+
+    @gen_test
+    def test_history_since(self):
+        for uid in ("1", "2", "3"):
+            yield self.app.engine.add_history_message(
+                "test", "test", {"uid": uid}, history_size=10, history_lifetime=60
+            )
+
+        result, error = yield self.app.process_call(
+            self.project, "history", {"channel": "test", "since": "2"}
+        )
+        self.assertEqual(error, None)
+        self.assertEqual(result, {"data": [{"uid": "3"}], "recovered": True})
+
+        result, error = yield self.app.process_call(
+            self.project, "history", {"channel": "test", "limit": 1}
+        )
+        self.assertEqual(result, [{"uid": "3"}])
+
 if __name__ == '__main__':
     main()
@@ -4,14 +4,16 @@ import sys
 import os
 import json
 import time
-from tornado.gen import Task
+from tornado.gen import Task, sleep
+from tornado.iostream import StreamClosedError
 from tornado.testing import AsyncTestCase, gen_test
 
 
 from centrifuge.engine import BaseEngine
 from centrifuge.engine.memory import Engine as MemoryEngine
-from centrifuge.engine.redis import Engine as RedisEngine
+from centrifuge.engine.redis import Engine as RedisEngine, CommandBatch
 from centrifuge.core import Application
+from centrifuge.response import Envelope
 
 
 class FakeClient(object):
@@ -19,6 +21,17 @@ class FakeClient(object):
     uid = 'test_uid'
 
 
+class RecordingClient(object):
+
+    def __init__(self, uid):
+        self.uid = uid
+        self.messages = []
+
+    def write(self, message):
+        self.messages.append(message)
+        return True
+
+
 class Options(object):
 
     redis_host = "localhost"
@@ -27,6 +40,9 @@ class Options(object):
     redis_db = 0
     redis_url = ""
     redis_api = False
+    redis_workers = 2
+    redis_unsubscribe_linger = 0
+    redis_presence_gc = False
 
 
 class BaseEngineTest(AsyncTestCase):
@@ -81,6 +97,41 @@ class MemoryEngineTest(AsyncTestCase):
             ) not in self.engine.subscriptions
         )
 
+    @gen_test
+    def test_broadcast(self):
+        clients = [RecordingClient('uid-%d' % i) for i in range(10)]
+        for client in clients:
+            yield self.engine.add_subscription(self.project_id, self.channel, client)
+
+        # force broadcast to give control back to IOLoop after every chunk
+        self.engine.broadcast_chunk_size = 3
+        self.engine.broadcast_time_slice = -1
+
+        key = self.engine.get_subscription_key(self.project_id, self.channel)
+        first = self.engine.broadcast(key, 'first')
+        second = self.engine.broadcast(key, 'second')
+        yield [first, second]
+
+        for client in clients:
+            self.assertEqual(client.messages, ['first', 'second'])
+
+    @gen_test
+    def test_publish_envelope(self):
+        client = RecordingClient(self.uid_1)
+        yield self.engine.add_subscription(self.project_id, self.channel, client)
+
+        message = {"uid": "message_uid", "data": "test"}
+        envelope = Envelope(message)
+        key = self.engine.get_subscription_key(self.project_id, self.channel)
+        yield self.engine.publish_message(key, envelope)
+        self.assertEqual(json.loads(client.messages[0])["body"], message)
+
+        yield self.engine.add_history_message(
+            self.project_id, self.channel, envelope, history_size=2, history_lifetime=1
+        )
+        result, error = yield self.engine.get_history(self.project_id, self.channel)
+        self.assertEqual(result, [message])
+
     @gen_test
     def test_presence(self):
         result, error = yield self.engine.get_presence(
@@ -141,6 +192,54 @@ class MemoryEngineTest(AsyncTestCase):
         )
         self.assertEqual(result, {})
 
+    @gen_test
+    def test_presence_many(self):
+        other_channel = "other_channel"
+        result, error = yield self.engine.add_presence_many([
+            (self.project_id, self.channel, self.uid_1, self.user_info),
+            (self.project_id, other_channel, self.uid_1, self.user_info)
+        ])
+        self.assertEqual(result, True)
+        result, error = yield self.engine.get_presence(self.project_id, other_channel)
+        self.assertTrue(self.uid_1 in result)
+
+        result, error = yield self.engine.remove_presence_many([
+            (self.project_id, self.channel, self.uid_1),
+            (self.project_id, other_channel, self.uid_1)
+        ])
+        self.assertEqual(result, True)
+        result, error = yield self.engine.get_presence(self.project_id, self.channel)
+        self.assertEqual(result, {})
+        result, error = yield self.engine.get_presence(self.project_id, other_channel)
+        self.assertEqual(result, {})
+
+    @gen_test
+    def test_presence_expire(self):
+        self.engine.presence_timeout = 0
+        self.engine.PRESENCE_EXPIRE_CHUNK_SIZE = 2
+        self.engine.PRESENCE_EXPIRE_TIME_SLICE = -1
+        yield self.engine.add_presence_many([
+            (self.project_id, "channel-%d" % i, self.uid_1, self.user_info) for i in range(5)
+        ])
+        self.engine.presence_timeout = 60
+        yield self.engine.add_presence(self.project_id, self.channel, self.uid_2, self.user_info)
+        self.assertEqual(len(self.engine.presence), 6)
+
+        yield self.engine.check_presence_expire()
+        self.assertEqual(len(self.engine.presence), 1)
+        self.assertEqual(len(self.engine.presence_expire), 1)
+
+    @gen_test
+    def test_remove_subscription_many(self):
+        client = RecordingClient(self.uid_1)
+        channels = ["channel-%d" % i for i in range(3)]
+        for channel in channels:
+            yield self.engine.add_subscription(self.project_id, channel, client)
+        yield self.engine.remove_subscription_many([
+            (self.project_id, channel, client) for channel in channels
+        ])
+        self.assertEqual(self.engine.subscriptions, {})
+
     @gen_test
     def test_history(self):
         result, error = yield self.engine.add_history_message(
@@ -179,6 +278,30 @@ class MemoryEngineTest(AsyncTestCase):
         self.assertEqual(error, None)
         self.assertEqual(len(result), 2)
 
+    @gen_test
+    def test_history_order_and_resize(self):
+        for message in (self.message_1, self.message_2, self.message_3):
+            yield self.engine.add_history_message(
+                self.project_id, self.channel, message, history_size=2, history_lifetime=1
+            )
+        result, error = yield self.engine.get_history(self.project_id, self.channel)
+        self.assertEqual(result, [self.message_3, self.message_2])
+
+        # returned history is a snapshot
+        result.append(self.message_1)
+
+        yield self.engine.add_history_message(
+            self.project_id, self.channel, self.message_1, history_size=1, history_lifetime=1
+        )
+        result, error = yield self.engine.get_history(self.project_id, self.channel)
+        self.assertEqual(result, [self.message_1])
+
+        yield self.engine.add_history_message(
+            self.project_id, self.channel, self.message_2, history_size=3, history_lifetime=1
+        )
+        result, error = yield self.engine.get_history(self.project_id, self.channel)
+        self.assertEqual(result, [self.message_2, self.message_1])
+
     @gen_test
     def test_history_expire(self):
         result, error = yield self.engine.add_history_message(
@@ -201,6 +324,48 @@ class MemoryEngineTest(AsyncTestCase):
         self.assertEqual(error, None)
         self.assertEqual(len(result), 0)
 
+    @gen_test
+    def test_history_expire_index(self):
+        for message in (self.message_1, self.message_2, self.message_3):
+            yield self.engine.add_history_message(
+                self.project_id, self.channel, message, history_size=2, history_lifetime=0
+            )
+        self.assertEqual(len(self.engine.history_expire), 1)
+
+        self.engine.check_history_expire()
+        self.assertEqual(len(self.engine.history_expire), 0)
+        self.assertEqual(self.engine.history, {})
+        self.assertEqual(self.engine.history_sizes, {})
+
+    @gen_test
+    def test_history_limit_offset(self):
+        for message in (self.message_1, self.message_2, self.message_3):
+            yield self.engine.add_history_message(
+                self.project_id, self.channel, message, history_size=3, history_lifetime=1
+            )
+        result, error = yield self.engine.get_history(self.project_id, self.channel, limit=2)
+        self.assertEqual(result, [self.message_3, self.message_2])
+        result, error = yield self.engine.get_history(
+            self.project_id, self.channel, limit=2, offset=2
+        )
+        self.assertEqual(result, [self.message_1])
+        result, error = yield self.engine.get_history(self.project_id, self.channel, offset=1)
+        self.assertEqual(result, [self.message_2, self.message_1])
+
+    @gen_test
+    def test_history_since(self):
+        messages = [{"uid": str(i)} for i in range(3)]
+        for message in messages:
+            yield self.engine.add_history_message(
+                self.project_id, self.channel, message, history_size=3, history_lifetime=1
+            )
+        result, error = yield self.engine.get_history_since(self.project_id, self.channel, "0")
+        self.assertEqual(result, ([{"uid": "2"}, {"uid": "1"}], True))
+        result, error = yield self.engine.get_history_since(self.project_id, self.channel, "2")
+        self.assertEqual(result, ([], True))
+        result, error = yield self.engine.get_history_since(self.project_id, self.channel, "lost")
+        self.assertEqual(result, ([{"uid": "2"}, {"uid": "1"}, {"uid": "0"}], False))
+
 
 class RedisEngineTest(AsyncTestCase):
     """ Test the client """
@@ -355,5 +520,275 @@ class RedisEngineTest(AsyncTestCase):
         self.assertEqual(len(result), 0)
 
 
+class FakeRedisClient(object):
+
+    def __init__(self):
+        self.pipelines = []
+        self.callbacks = []
+
+    def is_connected(self):
+        return True
+
+    def reply(self, command):
+        return command[0]
+
+    def send_messages(self, commands, callback):
+        self.pipelines.append(commands)
+        callback([self.reply(command) for command in commands])
+
+
+class DisconnectedRedisClient(FakeRedisClient):
+
+    def is_connected(self):
+        return False
+
+
+class NoScriptRedisClient(FakeRedisClient):
+
+    def reply(self, command):
+        if command[0] == "EVALSHA":
+            return Exception("NOSCRIPT No matching script")
+        return [b"uid", b'{"user": "1"}']
+
+
+class PresenceGCRedisClient(FakeRedisClient):
+
+    def __init__(self, locked=True):
+        super(PresenceGCRedisClient, self).__init__()
+        self.locked = locked
+        self.scans = [
+            [b"0", [b"centrifuge.presence.set.project.channel-2"]],
+            [b"12", [b"centrifuge.presence.set.project.channel-1"]],
+        ]
+
+    def reply(self, command):
+        if command[0] == "SET":
+            return b"OK" if self.locked else None
+        if command[0] == "SCAN":
+            return self.scans.pop()
+        return None
+
+
+class HistoryRedisClient(FakeRedisClient):
+
+    def reply(self, command):
+        return [b'{"uid": "1"}']
+
+
+class HistorySinceRedisClient(FakeRedisClient):
+
+    def reply(self, command):
+        return [1, b'{"uid": "2"}', b'{"uid": "1"}']
+
+
+class CommandBatchTest(AsyncTestCase):
+
+    @gen_test
+    def test_batch(self):
+        client = FakeRedisClient()
+        engine = type('FakeEngine', (object,), {'io_loop': self.io_loop})()
+        batch = CommandBatch(engine, lambda: client)
+
+        first = Task(batch.add, [["LPUSH", "key", "1"], ["LTRIM", "key", 0, 1]])
+        second = Task(batch.add, [["PUBLISH", "channel", "1"]])
+        (first_results, first_error), (second_results, second_error) = yield [first, second]
+
+        self.assertEqual(len(client.pipelines), 1)
+        self.assertEqual(first_results, ["LPUSH", "LTRIM"])
+        self.assertEqual(second_results, ["PUBLISH"])
+        self.assertEqual(first_error, None)
+        self.assertEqual(second_error, None)
+
+
+class FakeSubscriber(object):
+
+    def __init__(self):
+        self.commands = []
+
+    def is_connected(self):
+        return True
+
+    def subscribe(self, channels, callback=None):
+        self.commands.append(("SUBSCRIBE", sorted(channels)))
+
+    def unsubscribe(self, channels):
+        self.commands.append(("UNSUBSCRIBE", sorted(channels)))
+
+
+class RedisSubscriptionTest(AsyncTestCase):
+
+    def setUp(self):
+        super(RedisSubscriptionTest, self).setUp()
+        self.application = Application(**{'options': Options})
+        self.engine = RedisEngine(self.application, io_loop=self.io_loop)
+        self.engine.subscriber = FakeSubscriber()
+
+    @gen_test
+    def test_subscriptions_batched(self):
+        clients = [RecordingClient('uid-%d' % i) for i in range(3)]
+        for client in clients:
+            yield self.engine.add_subscription('project', 'channel', client)
+        yield self.engine.add_subscription('project', 'other', clients[0])
+        yield sleep(0.01)
+
+        key = self.engine.get_subscription_key('project', 'channel')
+        other_key = self.engine.get_subscription_key('project', 'other')
+        self.assertEqual(
+            self.engine.subscriber.commands, [("SUBSCRIBE", sorted([key, other_key]))]
+        )
+
+        for client in clients:
+            yield self.engine.remove_subscription('project', 'channel', client)
+        yield sleep(0.01)
+        self.assertEqual(self.engine.subscriber.commands[1:], [("UNSUBSCRIBE", [key])])
+
+    @gen_test
+    def test_subscription_flapping(self):
+        client = RecordingClient('uid')
+        yield self.engine.add_subscription('project', 'channel', client)
+        yield self.engine.remove_subscription('project', 'channel', client)
+        yield sleep(0.01)
+        self.assertEqual(self.engine.subscriber.commands, [])
+
+    @gen_test
+    def test_unsubscribe_linger(self):
+        self.engine.unsubscribe_linger = 0.01
+        client = RecordingClient('uid')
+        key = self.engine.get_subscription_key('project', 'channel')
+        yield self.engine.add_subscription('project', 'channel', client)
+        yield sleep(0.01)
+
+        yield self.engine.remove_subscription('project', 'channel', client)
+        yield self.engine.add_subscription('project', 'channel', client)
+        yield self.engine.remove_subscription('project', 'channel', client)
+        yield sleep(0.02)
+        self.assertEqual(self.engine.subscriber.commands, [("SUBSCRIBE", [key])])
+
+        self.engine.check_lingering()
+        yield sleep(0.01)
+        self.assertEqual(self.engine.subscriber.commands[1:], [("UNSUBSCRIBE", [key])])
+
+
+class RedisWorkerTestCase(AsyncTestCase):
+
+    def setUp(self):
+        super(RedisWorkerTestCase, self).setUp()
+        self.application = Application(**{'options': Options})
+        self.engine = RedisEngine(self.application, io_loop=self.io_loop)
+        self.engine.workers = [FakeRedisClient()]
+
+
+class RedisScriptTest(RedisWorkerTestCase):
+
+    @gen_test
+    def test_script_fallback(self):
+        self.engine.workers = [NoScriptRedisClient()]
+
+        result, error = yield self.engine.get_presence("project", "channel")
+        self.assertEqual(error, None)
+        self.assertEqual(result, {"uid": {"user": "1"}})
+        commands = [x[0][0] for x in self.engine.worker.pipelines]
+        self.assertEqual(commands, ["EVALSHA", "EVAL"])
+
+
+class RedisPublishTest(RedisWorkerTestCase):
+
+    @gen_test
+    def test_publish(self):
+        self.engine.publisher = FakeRedisClient()
+        result, error = yield self.engine.publish_message("channel", {"uid": "1"})
+        self.assertEqual((result, error), (True, None))
+        self.assertEqual(self.engine.publisher.pipelines[0][0][:2], ["PUBLISH", "channel"])
+
+    @gen_test
+    def test_publish_disconnected(self):
+        self.engine.publisher = DisconnectedRedisClient()
+        result, error = yield self.engine.publish_message("channel", {"uid": "1"})
+        self.assertEqual(result, False)
+        self.assertTrue(isinstance(error, StreamClosedError))
+        result, error = yield self.engine.publish_control_message({"method": "ping"})
+        self.assertEqual(result, False)
+        result, error = yield self.engine.publish_admin_message({"method": "ping"})
+        self.assertEqual(result, False)
+        self.assertEqual(self.engine.publisher.pipelines, [])
+
+
+class RedisPresenceTest(RedisWorkerTestCase):
+
+    @gen_test
+    def test_presence_many(self):
+        result, error = yield self.engine.add_presence_many([
+            ("project", "channel-%d" % i, "uid", {}) for i in range(3)
+        ])
+        self.assertEqual(error, None)
+        result, error = yield self.engine.remove_presence_many([
+            ("project", "channel-%d" % i, "uid") for i in range(3)
+        ])
+        self.assertEqual(error, None)
+
+        pipelines = self.engine.worker.pipelines
+        self.assertEqual(len(pipelines), 2)
+        self.assertEqual([x[0] for x in pipelines[0]], ["EVALSHA"] * 3)
+        self.assertEqual([x[0] for x in pipelines[1]], ["HDEL", "ZREM"] * 3)
+
+    @gen_test
+    def test_presence_gc(self):
+        self.engine.PRESENCE_GC_SCAN_DELAY = 0
+        self.engine.workers = [PresenceGCRedisClient()]
+
+        result, error = yield self.engine.collect_presence_garbage()
+        self.assertEqual(error, None)
+        self.assertEqual(result, True)
+        commands = [x[0] for x in self.engine.worker.pipelines]
+        self.assertEqual([x[0] for x in commands], ["SET", "SCAN", "EVALSHA", "SCAN", "EVALSHA"])
+        self.assertEqual(commands[2][3:5], [
+            "centrifuge.presence.set.project.channel-1",
+            "centrifuge.presence.hash.project.channel-1"
+        ])
+
+        self.engine.workers = [PresenceGCRedisClient(locked=False)]
+        result, error = yield self.engine.collect_presence_garbage()
+        self.assertEqual(result, False)
+        self.assertEqual(len(self.engine.worker.pipelines), 1)
+
+
+class RedisHistoryTest(RedisWorkerTestCase):
+
+    @gen_test
+    def test_history_limit_offset(self):
+        self.engine.workers = [HistoryRedisClient()]
+
+        result, error = yield self.engine.get_history("project", "channel", limit=10, offset=5)
+        self.assertEqual(result, [{"uid": "1"}])
+        yield self.engine.get_history("project", "channel")
+        commands = [x[0] for x in self.engine.worker.pipelines]
+        self.assertEqual(commands[0][2:], [5, 14])
+        self.assertEqual(commands[1][2:], [0, -1])
+
+        result, error = yield self.engine.get_history("project", "channel", raw=True)
+        self.assertEqual(result.encoded, '[{"uid": "1"}]')
+
+    @gen_test
+    def test_history_since(self):
+        self.engine.workers = [HistorySinceRedisClient()]
+
+        result, error = yield self.engine.get_history_since("project", "channel", "0")
+        self.assertEqual(error, None)
+        self.assertEqual(result, ([{"uid": "2"}, {"uid": "1"}], True))
+        command = self.engine.worker.pipelines[0][0]
+        self.assertEqual(command[:2], ["EVALSHA", self.engine.HISTORY_SINCE_SCRIPT.sha])
+        self.assertEqual(command[4:], ["0", self.engine.HISTORY_SINCE_CHUNK_SIZE])
+
+
+class RedisWorkerPoolTest(RedisWorkerTestCase):
+
+    def test_least_busy_worker(self):
+        busy, idle = FakeRedisClient(), FakeRedisClient()
+        busy.callbacks = [None, None]
+        idle.callbacks = [None]
+        self.engine.workers = [busy, idle]
+        self.assertTrue(self.engine.worker is idle)
+
+
 if __name__ == '__main__':
     main()
@@ -1,6 +1,12 @@
 # coding: utf-8
 from unittest import TestCase, main
 import time
+import struct
+import pickle
+
+from tornado.tcpserver import TCPServer
+from tornado.gen import sleep
+from tornado.testing import AsyncTestCase, gen_test, bind_unused_port
 
 
 from centrifuge.metrics import *
@@ -13,15 +19,28 @@ class CollectorTest(TestCase):
 
     def test_timer(self):
         timer = self.collector.get_timer('test')
-        time.sleep(0.1)
+        time.sleep(0.01)
         interval = timer.stop()
-        self.assertTrue(interval >= 0.1)
+        self.assertTrue(interval >= 10000)
+        self.assertTrue(isinstance(interval, int))
         metrics = self.collector.get()
         self.assertTrue('test.avg') in metrics
         self.assertTrue('test.min') in metrics
         self.assertTrue('test.max') in metrics
         self.assertTrue('test.count') in metrics
 
+    def test_timing_percentiles(self):
+        for interval in range(1, 1001):
+            self.collector.timing('test', interval)
+        metrics = self.collector.get()
+        self.assertEqual(metrics['test.count'], 1000)
+        self.assertEqual(metrics['test.min'], 1)
+        self.assertEqual(metrics['test.max'], 1000)
+        self.assertEqual(metrics['test.avg'], 500.5)
+        for key, expected in (('p50', 500), ('p90', 900), ('p99', 990), ('p999', 999)):
+            value = metrics['test.' + key]
+            self.assertTrue(abs(value - expected) <= expected * 0.01, (key, value))
+
     def test_counter(self):
         self.collector.incr('counter')
         self.collector.incr('counter', 5)
@@ -35,6 +54,99 @@ class CollectorTest(TestCase):
         metrics = self.collector.get()
         self.assertEqual(metrics['gauge'], 101)
 
+    def test_prometheus(self):
+        self.collector.incr('messages', 2)
+        self.collector.timing('broadcast', 100)
+        self.collector.get()
+        self.collector.incr('messages')
+        self.collector.timing('broadcast', 300)
+
+        text = ''.join(self.collector.iter_prometheus(gauges={'clients': 5}))
+        self.assertTrue('# TYPE centrifuge_messages_total counter\ncentrifuge_messages_total 3\n' in text)
+        self.assertTrue('centrifuge_clients 5\n' in text)
+        self.assertTrue('# TYPE centrifuge_broadcast_microseconds summary\n' in text)
+        self.assertTrue('centrifuge_broadcast_microseconds{quantile="0.999"} 300\n' in text)
+        self.assertTrue('centrifuge_broadcast_microseconds_sum 400\n' in text)
+        self.assertTrue('centrifuge_broadcast_microseconds_count 2\n' in text)
+
+        # rendering does not reset collector
+        self.assertEqual(self.collector.get()['messages.count'], 1)
+
+
+class HistogramTest(TestCase):
+
+    def test_buckets(self):
+        previous = -1
+        for value in range(0, 100000, 7):
+            bucket = Histogram.get_bucket(value)
+            self.assertTrue(bucket >= previous)
+            self.assertTrue(value <= Histogram.get_bucket_max(bucket))
+            self.assertTrue(Histogram.get_bucket_max(bucket) - value <= value * 0.01 + 1)
+            previous = bucket
+
+    def test_fixed_memory(self):
+        histogram = Histogram()
+        for _ in range(10):
+            for value in range(100000):
+                histogram.record(value)
+        self.assertEqual(histogram.count, 1000000)
+        self.assertTrue(len(histogram.buckets) < 1500)
+
+
+class ExporterTest(TestCase):
+
+    def test_pack(self):
+        exporter = Exporter("127.0.0.1", 2003, max_udp_size=30)
+        stats = ["metric.%d 1 1000" % i for i in range(10)]
+        datagrams = list(exporter.pack(stats))
+        self.assertTrue(all(len(x) <= 30 for x in datagrams))
+        self.assertEqual('\n'.join(datagrams).split('\n'), stats)
+        exporter.socket.close()
+
+    def test_pickle(self):
+        exporter = PickleExporter("127.0.0.1", 2004, prefix="node")
+        exporter.BATCH_SIZE = 2
+        chunks = exporter.encode({"a": 1, "b": 2, "c": 3})
+        self.assertEqual(len(chunks), 2)
+        items = []
+        for chunk in chunks:
+            length = struct.unpack("!L", chunk[:4])[0]
+            self.assertEqual(length, len(chunk) - 4)
+            items.extend(pickle.loads(chunk[4:]))
+        self.assertEqual(sorted((key, value) for key, (_, value) in items), [
+            ("node.a", 1), ("node.b", 2), ("node.c", 3)
+        ])
+
+
+class GraphiteServer(TCPServer):
+
+    def __init__(self, *args, **kwargs):
+        super(GraphiteServer, self).__init__(*args, **kwargs)
+        self.lines = []
+
+    def handle_stream(self, stream, address):
+        stream.read_until_close(streaming_callback=self.lines.append)
+
+
+class TCPExporterTest(AsyncTestCase):
+
+    @gen_test
+    def test_export(self):
+        sock, port = bind_unused_port()
+        server = GraphiteServer(io_loop=self.io_loop)
+        server.add_socket(sock)
+
+        exporter = TCPExporter("127.0.0.1", port, prefix="node", io_loop=self.io_loop)
+        exporter.export({"messages": 10})
+        exporter.export({"clients": 5})
+        yield sleep(0.1)
+        data = b''.join(server.lines).decode()
+        self.assertTrue(data.startswith("node.messages 10 "))
+        self.assertTrue("\nnode.clients 5 " in data)
+
+        exporter.stream.close()
+        server.stop()
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,26 @@
+# coding: utf-8
+import time
+
+from tornado.gen import sleep
+from tornado.testing import AsyncTestCase, gen_test
+
+from centrifuge.metrics import Collector
+from centrifuge.monitor import LoopMonitor
+
+
+class LoopMonitorTest(AsyncTestCase):
+
+    @gen_test
+    def test_lag(self):
+        collector = Collector()
+        monitor = LoopMonitor(collector, interval=10, io_loop=self.io_loop)
+        monitor.start()
+
+        # block IOLoop for 50 milliseconds
+        self.io_loop.add_timeout(self.io_loop.time() + 0.005, lambda: time.sleep(0.05))
+        yield sleep(0.1)
+        monitor.stop()
+
+        metrics = collector.get()
+        self.assertTrue(metrics['ioloop_lag.count'] >= 2)
+        self.assertTrue(metrics['ioloop_lag.max'] >= 30000)
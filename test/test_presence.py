@@ -0,0 +1,68 @@
+# coding: utf-8
+from tornado.gen import coroutine, Return
+from tornado.testing import AsyncTestCase, gen_test
+
+from centrifuge.presence import PresenceScheduler
+
+
+class FakeEngine(object):
+
+    presence_ping_interval = 3000
+
+    def __init__(self):
+        self.calls = []
+
+    @coroutine
+    def add_presence_many(self, presences):
+        self.calls.append(presences)
+        raise Return((True, None))
+
+
+class FakeApplication(object):
+
+    def __init__(self):
+        self.engine = FakeEngine()
+
+
+class FakeClient(object):
+
+    def __init__(self, uid):
+        self.uid = uid
+
+    def get_presences(self):
+        return [("project", "channel", self.uid, {})]
+
+
+class PresenceSchedulerTest(AsyncTestCase):
+
+    def setUp(self):
+        super(PresenceSchedulerTest, self).setUp()
+        self.application = FakeApplication()
+        self.scheduler = PresenceScheduler(self.application, io_loop=self.io_loop)
+
+    @gen_test
+    def test_slots(self):
+        self.assertEqual(len(self.scheduler.slots), 3)
+        clients = [FakeClient('uid-%d' % i) for i in range(6)]
+        for client in clients:
+            self.scheduler.add(client)
+        self.assertEqual(len(self.scheduler), 6)
+
+        for _ in range(3):
+            yield self.scheduler.tick()
+
+        calls = self.application.engine.calls
+        self.assertEqual(len(calls), 3)
+        self.assertEqual([len(x) for x in calls], [2, 2, 2])
+        uids = sorted(x[2] for call in calls for x in call)
+        self.assertEqual(uids, sorted(x.uid for x in clients))
+
+    @gen_test
+    def test_remove(self):
+        client = FakeClient('uid')
+        self.scheduler.add(client)
+        self.scheduler.remove(client)
+        self.assertEqual(len(self.scheduler), 0)
+        for _ in range(3):
+            yield self.scheduler.tick()
+        self.assertEqual(self.application.engine.calls, [])
@@ -61,5 +61,39 @@ class MultiResponseTest(TestCase):
         self.assertEqual(response["body"], "test_body2")
 
 
+class EnvelopeTest(TestCase):
+
+    def test_envelope(self):
+        message = {"uid": "uid", "channel": "channel", "data": {"input": "test"}}
+        envelope = Envelope(message)
+        self.assertEqual(json.loads(envelope.encoded), message)
+
+        response = json.loads(envelope.as_response("message"))
+        self.assertEqual(response, {"method": "message", "error": None, "body": message})
+
+        admin_message = json.loads(envelope.as_admin_message("project"))
+        self.assertEqual(admin_message["method"], "message")
+        self.assertEqual(admin_message["body"], {"project": "project", "message": message})
+
+
+class RawJSONTest(TestCase):
+
+    def test_splice(self):
+        messages = [{"uid": "1", "data": "a"}, {"uid": "2", "data": "b"}]
+        data = RawJSON.from_list(json.dumps(x) for x in messages)
+        response = Response(method="history", body={"channel": "test", "data": data})
+        decoded = json.loads(response.as_message())
+        self.assertEqual(decoded["body"], {"channel": "test", "data": messages})
+
+        multi_response = MultiResponse()
+        multi_response.add_many([response, Response(method="history", body=data)])
+        decoded = json.loads(multi_response.as_message())
+        self.assertEqual(decoded[0]["body"]["data"], messages)
+        self.assertEqual(decoded[1]["body"], messages)
+
+        self.assertEqual(json.loads(json_encode_raw({"data": RawJSON.from_list([])}, "data")), {"data": []})
+        self.assertEqual(json.loads(json_encode_raw({"data": [1]}, "data")), {"data": [1]})
+
+
 if __name__ == '__main__':
     main()
@@ -60,6 +60,32 @@ class SchemaTest(TestCase):
             None
         )
 
+    def test_server_api_schema_history(self):
+        schema = {
+            "channel": "test",
+            "since": "uid"
+        }
+
+        self.assertEqual(
+            validate(schema, server_api_schema["history"]),
+            None
+        )
+
+        schema["limit"] = 10
+        try:
+            validate(schema, server_api_schema["history"])
+        except ValidationError:
+            pass
+        else:
+            raise AssertionError("Exception must be raised here")
+
+        del schema["since"]
+        schema["offset"] = 10
+        self.assertEqual(
+            validate(schema, server_api_schema["history"]),
+            None
+        )
+
     def test_client_api_schema_subscribe(self):
         schema = {
             "namespace": "channel",
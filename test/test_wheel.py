@@ -0,0 +1,49 @@
+# coding: utf-8
+from unittest import TestCase, main
+
+from centrifuge.wheel import TimingWheel
+
+
+class TimingWheelTest(TestCase):
+
+    def setUp(self):
+        self.wheel = TimingWheel(resolution=10)
+
+    def test_expire(self):
+        self.wheel.add('a', 5)
+        self.wheel.add('b', 15)
+        self.wheel.add('c', 17)
+        self.assertEqual(len(self.wheel), 3)
+
+        self.assertEqual(self.wheel.expire(4), [])
+        self.assertEqual(self.wheel.expire(15), ['a', 'b'])
+        self.assertTrue('c' in self.wheel)
+        self.assertEqual(self.wheel.expire(100), ['c'])
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(self.wheel.heap, [])
+
+    def test_one_deadline_per_key(self):
+        for deadline in range(100):
+            self.wheel.add('a', deadline)
+        self.assertEqual(len(self.wheel), 1)
+        self.assertEqual(self.wheel.get('a'), 99)
+        self.assertEqual(self.wheel.expire(50), [])
+        self.assertEqual(self.wheel.expire(99), ['a'])
+
+    def test_discard(self):
+        self.wheel.add('a', 5)
+        self.wheel.discard('a')
+        self.wheel.discard('b')
+        self.assertEqual(self.wheel.expire(100), [])
+
+    def test_limit(self):
+        for i in range(5):
+            self.wheel.add(i, i)
+        first = self.wheel.expire(100, limit=3)
+        self.assertEqual(len(first), 3)
+        second = self.wheel.expire(100, limit=3)
+        self.assertEqual(sorted(first + second), list(range(5)))
+
+
+if __name__ == '__main__':
+    main()